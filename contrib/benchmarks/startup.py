@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+startup - measures what flask-webcache adds to the startup time of a process
+
+Every measurement is taken in a fresh interpreter (so nothing is already imported), repeated a few times and the
+median is reported. Measured are:
+ - import flask:               the baseline, as any app using flask-webcache already imports flask
+ - import flask_webcache:      importing just the package (submodules are imported lazily)
+ - import flask_webcache (+):  importing the package after flask was imported
+ - easy_setup (+):             calling easy_setup() on a new app, after both packages were imported
+
+Run it from the repository root (or with flask_webcache importable):
+    % python contrib/benchmarks/startup.py
+"""
+from __future__ import division, print_function, unicode_literals
+import subprocess
+import sys
+
+PROGRAM = """
+from time import time
+{setup}
+started = time()
+{statement}
+print(time() - started)
+"""
+
+MEASUREMENTS = (
+    ('import flask', '', 'import flask'),
+    ('import flask_webcache', '', 'import flask_webcache'),
+    ('import flask_webcache (+)', 'import flask', 'import flask_webcache'),
+    ('easy_setup (+)', 'import flask, flask_webcache\napp = flask.Flask("startup")',
+     'flask_webcache.easy_setup(app)'),
+)
+
+def measure(setup, statement, repeat):
+    program = PROGRAM.format(setup=setup, statement=statement)
+    timings = sorted(
+        float(subprocess.check_output([sys.executable, '-c', program]))
+        for i in range(repeat)
+    )
+    return timings[len(timings)//2]
+
+def main(repeat=7):
+    for name, setup, statement in MEASUREMENTS:
+        print('%-28s %8.2fms' % (name, measure(setup, statement, repeat) * 1000))
+
+if __name__ == '__main__':
+    main()
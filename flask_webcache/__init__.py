@@ -1,14 +1,36 @@
 from __future__ import unicode_literals
-from werkzeug.contrib.cache import SimpleCache
+from importlib import import_module
+from types import ModuleType
+import sys
 
-from . import storage, validation, handlers, modifiers, utils, recache
-modifiers, validation, recache # silence pyflakes etc
+# submodules are only imported when first used, see the module class below
+SUBMODULES = ('storage', 'validation', 'handlers', 'modifiers', 'utils',
+              'recache', 'backends', 'cli', 'simulation')
 
 def easy_setup(app, cache=None):
-    cache = cache or SimpleCache()
+    from . import storage, handlers, utils, backends
+    cache = cache or backends.MemoryCache()
     config = storage.Config(
         resource_exemptions = ('/static/',),
         master_salt = utils.make_salt() if app.debug else '',
     )
     handlers.RequestHandler(cache, app, config)
     handlers.ResponseHandler(cache, app, config)
+
+class module(ModuleType):
+    "Imports submodules on attribute access, like werkzeug's own package"
+    def __getattr__(self, name):
+        if name in SUBMODULES:
+            return import_module('.' + name, self.__name__)
+        raise AttributeError('module %r has no attribute %r'
+                             % (self.__name__, name))
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(SUBMODULES))
+
+# keep a reference to the original module; python 2 clears the globals of
+#  modules when they're collected, and easy_setup still uses them
+_original_module = sys.modules[__name__]
+_lazy_module = module(__name__)
+_lazy_module.__dict__.update(_original_module.__dict__)
+_lazy_module._original_module = _original_module
+sys.modules[__name__] = _lazy_module
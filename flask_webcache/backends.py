@@ -0,0 +1,737 @@
+from __future__ import unicode_literals
+from bisect import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+from heapq import heappush, heappop
+from threading import Condition, Lock, Thread
+from time import time
+import hashlib
+import os
+import struct
+import sys
+
+from six.moves import cPickle as pickle
+from flask import g, has_request_context
+
+from werkzeug.contrib.cache import BaseCache
+from werkzeug.wrappers import BaseResponse
+
+from .utils import copy_response
+
+def entry_size(value):
+    if isinstance(value, BaseResponse):
+        # frozen responses are what we store most and their body dominates
+        size = value.calculate_content_length() or 0
+        for key, header in value.headers:
+            size += len(key) + len(header)
+        return size
+    return sys.getsizeof(value)
+
+class MemoryCache(BaseCache):
+    """Thread safe in-process cache made for webcache entries.
+
+       Unlike werkzeug's SimpleCache, values are stored by reference rather
+       than pickled, so they must be treated as immutable once stored
+       (responses are shallowly copied on storage and retrieval, since
+       handlers and other after_request hooks modify their headers).
+       Eviction is LRU and O(1), bounded both by entry count (threshold) and
+       by an estimate of the size of stored values (max_bytes); expired
+       entries are purged in bulk from per-second buckets rather than by
+       scanning the whole cache."""
+    WHEEL_RESOLUTION = 1
+    def __init__(self, threshold=None, max_bytes=64*1024*1024,
+                 default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict() # key -> (value, expires, size)
+        self._wheel = {} # bucket -> keys expiring in bucket
+        self._wheel_heap = []
+        self._bytes = 0
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time() + timeout
+        return timeout
+    def _bucket(self, expires):
+        return int(expires // self.WHEEL_RESOLUTION)
+    def _is_live(self, expires, now):
+        return expires == 0 or expires > now
+    def _remove(self, key):
+        value, expires, size = self._entries.pop(key)
+        self._bytes -= size
+        if expires:
+            bucket = self._wheel.get(self._bucket(expires))
+            if bucket is not None:
+                bucket.discard(key)
+    def _insert(self, key, value, expires):
+        if isinstance(value, BaseResponse):
+            value = copy_response(value) # callers keep modifying theirs
+        size = entry_size(value)
+        if self._max_bytes is not None and size > self._max_bytes:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires, size)
+        self._bytes += size
+        if expires:
+            bucket = self._bucket(expires)
+            if bucket not in self._wheel:
+                self._wheel[bucket] = set()
+                heappush(self._wheel_heap, bucket)
+            self._wheel[bucket].add(key)
+        self._evict()
+        return True
+    def _expire(self, now):
+        current = self._bucket(now)
+        while self._wheel_heap and self._wheel_heap[0] <= current:
+            bucket = self._wheel_heap[0]
+            keys = self._wheel[bucket]
+            for key in list(keys):
+                if not self._is_live(self._entries[key][1], now):
+                    self._remove(key)
+            if bucket < current or not keys:
+                # a partially expired current bucket is revisited next time
+                heappop(self._wheel_heap)
+                del self._wheel[bucket]
+            else:
+                break
+    def _evict(self):
+        while self._entries and (
+            (self._threshold is not None and
+             len(self._entries) > self._threshold) or
+            (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            self._remove(next(iter(self._entries)))
+    def _lookup(self, key, now):
+        try:
+            value, expires, size = self._entries[key]
+        except KeyError:
+            return None
+        if not self._is_live(expires, now):
+            self._remove(key)
+            return None
+        self._entries[key] = self._entries.pop(key) # mark recently used
+        return value
+    def get(self, key):
+        with self._lock:
+            value = self._lookup(key, time())
+        if isinstance(value, BaseResponse):
+            return copy_response(value)
+        return value
+    def set(self, key, value, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        with self._lock:
+            self._expire(time())
+            return self._insert(key, value, expires)
+    def add(self, key, value, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        with self._lock:
+            now = time()
+            self._expire(now)
+            if self._lookup(key, now) is not None:
+                return False
+            return self._insert(key, value, expires)
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+    def has(self, key):
+        with self._lock:
+            return self._lookup(key, time()) is not None
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._wheel.clear()
+            del self._wheel_heap[:]
+            self._bytes = 0
+        return True
+    def inc(self, key, delta=1):
+        with self._lock:
+            now = time()
+            value = (self._lookup(key, now) or 0) + delta
+            expires = self._entries[key][1] if key in self._entries else 0
+            self._insert(key, value, expires)
+            return value
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+    def __len__(self):
+        return len(self._entries)
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+def shared_memory_path(name):
+    "A path for a SharedMemoryCache named name, in /dev/shm if available"
+    import tempfile
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'flask-webcache-' + name)
+
+CORRUPT = object()
+
+class SharedMemoryCache(BaseCache):
+    """Cache shared by all processes on a host, for prefork servers.
+
+       Entries are pickled into fixed size slots of a memory mapped file
+       (say, in /dev/shm; see shared_memory_path). A key may only live in one
+       of PROBE_LIMIT slots following the slot its hash points at; when these
+       are all taken, the one closest to expiry is evicted. Values which don't
+       fit in a slot aren't stored at all. All processes opening the same path
+       with the same geometry share entries; opening a file created with a
+       different geometry raises ValueError, as it may be in use. Every app
+       should have a path of its own, or apps will serve each other's
+       responses."""
+    MAGIC = b'FWCSHM1\0'
+    FILE_HEADER = struct.Struct('<8sII')
+    SLOT_HEADER = struct.Struct('<B3xQdHI') # used, hash, expires, klen, vlen
+    PROBE_LIMIT = 8
+    def __init__(self, path, slots=1024, slot_size=64*1024,
+                 default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._path = path
+        self._slots = slots
+        self._slot_size = slot_size
+        self._thread_lock = Lock() # record locks don't exclude threads
+        self._file = None
+        self._map = None
+        self._open()
+    def _open(self):
+        import mmap
+        size = self.FILE_HEADER.size + self._slots * self._slot_size
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, 'r+b')
+        try:
+            with self._locked(exclusive=True):
+                header = self._file.read(self.FILE_HEADER.size)
+                expected = self.FILE_HEADER.pack(self.MAGIC, self._slots,
+                                                 self._slot_size)
+                if not header.strip(b'\0'): # a new file
+                    self._file.truncate(size)
+                    self._file.seek(0)
+                    self._file.write(expected)
+                    self._file.flush()
+                elif header != expected or os.fstat(fd).st_size != size:
+                    # other processes may have it mapped; resizing it under
+                    #  them would crash them (SIGBUS) or corrupt entries
+                    raise ValueError('%s is a shared memory cache with another '
+                                     'geometry; use another path, or remove it '
+                                     'when no process uses it' % self._path)
+                self._map = mmap.mmap(fd, size)
+        except Exception:
+            self._file.close()
+            raise
+    def close(self):
+        self._map.close()
+        self._file.close()
+    @contextmanager
+    def _locked(self, exclusive):
+        import fcntl
+        with self._thread_lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time() + timeout
+        return timeout
+    def _encode_key(self, key):
+        return key.encode('utf-8') if not isinstance(key, bytes) else key
+    def _hash(self, key):
+        return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+    def _offset(self, index):
+        return self.FILE_HEADER.size + index * self._slot_size
+    def _probe(self, key_hash):
+        for i in range(min(self.PROBE_LIMIT, self._slots)):
+            yield (key_hash + i) % self._slots
+    def _read_header(self, index):
+        return self.SLOT_HEADER.unpack_from(self._map, self._offset(index))
+    def _mark_unused(self, index):
+        offset = self._offset(index)
+        self._map[offset:offset + 1] = b'\0'
+    def _is_live(self, expires, now):
+        return expires == 0 or expires > now
+    def _find(self, key, key_hash):
+        for index in self._probe(key_hash):
+            used, slot_hash, expires, klen, vlen = self._read_header(index)
+            if not used or slot_hash != key_hash:
+                continue
+            start = self._offset(index) + self.SLOT_HEADER.size
+            if self._map[start:start + klen] == key:
+                return index, expires, start + klen, vlen
+        return None
+    def _read(self, key, now, exclusive=True):
+        # returns CORRUPT for unreadable slots when not holding the exclusive
+        #  lock, which is needed to discard them
+        found = self._find(key, self._hash(key))
+        if found is None:
+            return None
+        index, expires, start, vlen = found
+        if not self._is_live(expires, now):
+            return None
+        try:
+            return pickle.loads(self._map[start:start + vlen])
+        except Exception: # e.g. torn by a process killed while writing it
+            if not exclusive:
+                return CORRUPT
+            self._mark_unused(index)
+            return None
+    def _write(self, key, value, expires, now):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.SLOT_HEADER.size + len(key) + len(data) > self._slot_size:
+            return False
+        key_hash = self._hash(key)
+        found = self._find(key, key_hash)
+        if found is not None:
+            index = found[0]
+        else:
+            index = self._free_slot(key_hash, now)
+        offset = self._offset(index)
+        start = offset + self.SLOT_HEADER.size
+        self._map[start:start + len(key)] = key
+        self._map[start + len(key):start + len(key) + len(data)] = data
+        self.SLOT_HEADER.pack_into(self._map, offset, 1, key_hash, expires,
+                                   len(key), len(data))
+        return True
+    def _free_slot(self, key_hash, now):
+        victim, victim_expires = None, None
+        for index in self._probe(key_hash):
+            used, slot_hash, expires, klen, vlen = self._read_header(index)
+            if not used or not self._is_live(expires, now):
+                return index
+            expires = expires or float('inf')
+            if victim is None or expires < victim_expires:
+                victim, victim_expires = index, expires
+        return victim
+    def get(self, key):
+        key = self._encode_key(key)
+        with self._locked(exclusive=False):
+            value = self._read(key, time(), exclusive=False)
+        if value is CORRUPT:
+            with self._locked(exclusive=True):
+                return self._read(key, time()) # rereads and discards
+        return value
+    def set(self, key, value, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        with self._locked(exclusive=True):
+            return self._write(self._encode_key(key), value, expires, time())
+    def add(self, key, value, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        key = self._encode_key(key)
+        with self._locked(exclusive=True):
+            now = time()
+            if self._read(key, now) is not None:
+                return False
+            return self._write(key, value, expires, now)
+    def delete(self, key):
+        key = self._encode_key(key)
+        with self._locked(exclusive=True):
+            found = self._find(key, self._hash(key))
+            if found is None:
+                return False
+            self._mark_unused(found[0])
+            return True
+    def has(self, key):
+        key = self._encode_key(key)
+        with self._locked(exclusive=False):
+            found = self._find(key, self._hash(key))
+            return found is not None and self._is_live(found[1], time())
+    def clear(self):
+        with self._locked(exclusive=True):
+            for index in range(self._slots):
+                self._mark_unused(index)
+        return True
+    def inc(self, key, delta=1):
+        key = self._encode_key(key)
+        with self._locked(exclusive=True):
+            now = time()
+            found = self._find(key, self._hash(key))
+            expires = found[1] if found and self._is_live(found[1], now) else 0
+            value = (self._read(key, now) or 0) + delta
+            self._write(key, value, expires, now)
+            return value
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+class ShardedCache(BaseCache):
+    """Spreads webcache keys over several caches with a consistent hash ring.
+
+       Keys are placed by the resource they belong to rather than by the
+       whole key, so a resource's metadata, representations and recache
+       lock all live on the same node. `nodes` maps node names (which place
+       the node on the ring, so keep them stable) to werkzeug caches; adding
+       or removing a node only moves the keys of about 1/N resources."""
+    RESOURCE_NAMESPACES = {'metadata': 1, 'representation': 2, 'recache': 2}
+    REPLICAS = 100
+    def __init__(self, nodes=None, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._nodes = {}
+        self._ring = []
+        self._points = {}
+        for name, cache in (nodes or {}).items():
+            self.add_node(name, cache)
+    def _hash(self, s):
+        return struct.unpack('<Q', hashlib.md5(s.encode('utf-8')).digest()[:8])[0]
+    def _rebuild(self):
+        self._ring = sorted(self._points)
+    def add_node(self, name, cache):
+        self._nodes[name] = cache
+        for i in range(self.REPLICAS):
+            self._points[self._hash('%s#%d' % (name, i))] = name
+        self._rebuild()
+    def remove_node(self, name):
+        del self._nodes[name]
+        for point, owner in list(self._points.items()):
+            if owner == name:
+                del self._points[point]
+        self._rebuild()
+    def resource_of(self, key):
+        namespace = key.split(':', 1)[0]
+        parts = self.RESOURCE_NAMESPACES.get(namespace)
+        if parts is None:
+            return key
+        return key.split(':', parts)[-1]
+    def node_name_for(self, key):
+        if not self._ring:
+            raise KeyError('no nodes in sharded cache')
+        index = bisect(self._ring, self._hash(self.resource_of(key)))
+        return self._points[self._ring[index % len(self._ring)]]
+    def node_for(self, key):
+        return self._nodes[self.node_name_for(key)]
+    def _group(self, keys):
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.node_name_for(key), []).append(key)
+        return groups
+    def get(self, key):
+        return self.node_for(key).get(key)
+    def get_many(self, *keys):
+        values = {}
+        for name, group in self._group(keys).items():
+            values.update(zip(group, self._nodes[name].get_many(*group)))
+        return [values[key] for key in keys]
+    def set(self, key, value, timeout=None):
+        return self.node_for(key).set(key, value, timeout)
+    def add(self, key, value, timeout=None):
+        return self.node_for(key).add(key, value, timeout)
+    def set_many(self, mapping, timeout=None):
+        rv = True
+        for name, group in self._group(mapping).items():
+            subset = dict((key, mapping[key]) for key in group)
+            rv = self._nodes[name].set_many(subset, timeout) and rv
+        return rv
+    def delete(self, key):
+        return self.node_for(key).delete(key)
+    def delete_many(self, *keys):
+        rv = True
+        for name, group in self._group(keys).items():
+            rv = self._nodes[name].delete_many(*group) and rv
+        return rv
+    def has(self, key):
+        return self.node_for(key).has(key)
+    def clear(self):
+        rv = True
+        for cache in self._nodes.values():
+            rv = cache.clear() and rv
+        return rv
+    def inc(self, key, delta=1):
+        return self.node_for(key).inc(key, delta)
+    def dec(self, key, delta=1):
+        return self.node_for(key).dec(key, delta)
+
+class CircuitBreakerCache(BaseCache):
+    """Wraps a cache so that a slow or failing backend degrades to no caching.
+
+       Calls that raise or take longer than `timeout` seconds count as
+       failures; after `failure_threshold` consecutive failures the breaker
+       opens and all calls are bypassed (gets miss, writes are dropped) for
+       `reset_seconds`, after which a single probe call is let through
+       (half-open) to decide whether to close the breaker again. Within a
+       request, calls are also bypassed once they took `request_budget`
+       seconds in total. Note that slow calls aren't interrupted, so
+       configure the backend client's own socket timeouts too.
+
+       Invalidations (delete, delete_many and clear) are never bypassed, as
+       dropping them would serve stale content once the breaker closes.
+       Deletes which fail are queued, retried after the next successful call
+       and meanwhile read as misses; beyond `max_pending_deletes` the oldest
+       are dropped (see status()), so their keys may be stale until they
+       expire."""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    def __init__(self, cache, app=None, timeout=0.05, request_budget=0.1,
+                 failure_threshold=5, reset_seconds=30, clock=time,
+                 max_pending_deletes=10000):
+        BaseCache.__init__(self, cache.default_timeout)
+        self.cache = cache
+        self.timeout = timeout
+        self.request_budget = request_budget
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.max_pending_deletes = max_pending_deletes
+        self.lock = Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.bypassed = 0
+        self.pending_deletes = OrderedDict() # keys whose delete failed
+        self.dropped_invalidations = 0
+        if app is not None:
+            self.init_app(app)
+    def init_app(self, app):
+        from .handlers import register_extension
+        register_extension(app, 'breaker', self)
+    def status(self):
+        return dict(state=self.state, failures=self.failures,
+                    opened_at=self.opened_at, bypassed=self.bypassed,
+                    pending_deletes=len(self.pending_deletes),
+                    dropped_invalidations=self.dropped_invalidations)
+    def request_seconds(self, delta=0):
+        if not has_request_context():
+            return 0
+        g.webcache_backend_seconds = getattr(g, 'webcache_backend_seconds',
+                                             0) + delta
+        return g.webcache_backend_seconds
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+        return (self.request_budget is None or
+                self.request_seconds() < self.request_budget)
+    def record(self, success):
+        with self.lock:
+            self.probing = False
+            if success:
+                self.failures = 0
+                self.state = self.CLOSED
+                return
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+    def call(self, default, method, *args):
+        if not self.allow():
+            self.bypassed += 1
+            return default
+        started = self.clock()
+        try:
+            rv = getattr(self.cache, method)(*args)
+        except Exception:
+            rv, success = default, False
+        else:
+            success = True
+        duration = self.clock() - started
+        self.request_seconds(duration)
+        self.record(success and duration <= self.timeout)
+        if success and self.pending_deletes:
+            self.retry_deletes()
+        return rv
+    def invalidate(self, method, *args):
+        # not gated by the breaker, nor counted towards opening it; returns
+        #  the result and whether the backend could be reached
+        started = self.clock()
+        try:
+            return getattr(self.cache, method)(*args), True
+        except Exception:
+            return False, False
+        finally:
+            self.request_seconds(self.clock() - started)
+    def queue_deletes(self, keys):
+        with self.lock:
+            for key in keys:
+                self.pending_deletes.pop(key, None)
+                self.pending_deletes[key] = True
+            while len(self.pending_deletes) > self.max_pending_deletes:
+                self.pending_deletes.popitem(last=False)
+                self.dropped_invalidations += 1
+    def retry_deletes(self):
+        with self.lock:
+            keys = list(self.pending_deletes)
+        try:
+            self.cache.delete_many(*keys)
+        except Exception:
+            return
+        with self.lock:
+            for key in keys:
+                self.pending_deletes.pop(key, None)
+    def get(self, key):
+        if key in self.pending_deletes:
+            return None
+        return self.call(None, 'get', key)
+    def get_many(self, *keys):
+        rv = self.call([None] * len(keys), 'get_many', *keys)
+        return [None if key in self.pending_deletes else value
+                for key, value in zip(keys, rv)]
+    def set(self, key, value, timeout=None):
+        return self.call(False, 'set', key, value, timeout)
+    def add(self, key, value, timeout=None):
+        return self.call(False, 'add', key, value, timeout)
+    def set_many(self, mapping, timeout=None):
+        return self.call(False, 'set_many', mapping, timeout)
+    def delete(self, key):
+        rv, success = self.invalidate('delete', key)
+        if not success:
+            self.queue_deletes([key])
+        return rv
+    def delete_many(self, *keys):
+        # a failed delete_many may have deleted some keys; retrying is safe
+        rv, success = self.invalidate('delete_many', *keys)
+        if not success:
+            self.queue_deletes(keys)
+        return rv
+    def has(self, key):
+        if key in self.pending_deletes:
+            return False
+        return self.call(False, 'has', key)
+    def clear(self):
+        rv, success = self.invalidate('clear')
+        if not success:
+            self.dropped_invalidations += 1
+        else:
+            with self.lock:
+                self.pending_deletes.clear()
+        return rv
+    def inc(self, key, delta=1):
+        return self.call(None, 'inc', key, delta)
+    def dec(self, key, delta=1):
+        return self.call(None, 'dec', key, delta)
+
+class WriteBehindCache(BaseCache):
+    """Wraps a cache so that set() calls are written by a background thread.
+
+       Only set() is deferred, which is what stores representations (the
+       bulk of the serialization and transfer work of caching a response).
+       add() stays synchronous, as metadata creation relies on its atomicity,
+       and so does delete(), which also cancels pending writes to the key so
+       invalidations are never lost. Pending writes to the same key are
+       coalesced, and writes arriving while `max_pending` writes are pending
+       are dropped. Reads see pending writes, and inc() and dec() wait for
+       pending writes to their key."""
+    def __init__(self, cache, app=None, max_pending=1000):
+        BaseCache.__init__(self, cache.default_timeout)
+        self.cache = cache
+        self.max_pending = max_pending
+        self.condition = Condition()
+        self.pending = OrderedDict() # key -> (value, timeout)
+        self.in_flight = None
+        self.deleted_in_flight = False
+        self.written = self.coalesced = self.dropped = self.errors = 0
+        self.writer_pid = None
+        if app is not None:
+            self.init_app(app)
+    def init_app(self, app):
+        from .handlers import register_extension
+        register_extension(app, 'writer', self)
+    def status(self):
+        with self.condition:
+            return dict(depth=len(self.pending), written=self.written,
+                        coalesced=self.coalesced, dropped=self.dropped,
+                        errors=self.errors)
+    def ensure_writer(self):
+        if self.writer_pid == os.getpid():
+            return
+        self.writer_pid = os.getpid() # threads don't survive a fork
+        thread = Thread(target=self.write_forever)
+        thread.daemon = True
+        thread.start()
+    def write_forever(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, (value, timeout) = self.pending.popitem(last=False)
+                self.in_flight = key
+            try:
+                self.cache.set(key, value, timeout)
+                with self.condition:
+                    deleted = self.deleted_in_flight
+                if deleted: # deleted while being written, delete it again
+                    self.cache.delete(key)
+                failed = False
+            except Exception:
+                failed = True
+            with self.condition:
+                if failed:
+                    self.errors += 1
+                else:
+                    self.written += 1
+                self.in_flight = None
+                self.deleted_in_flight = False
+                self.condition.notify_all()
+    def flush(self, timeout=None):
+        "Waits for pending writes to be written; returns whether they were"
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while self.pending or self.in_flight is not None:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+    def set(self, key, value, timeout=None):
+        if isinstance(value, BaseResponse):
+            value = copy_response(value) # callers keep modifying theirs
+        with self.condition:
+            if key in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending[key] = (value, timeout)
+            self.ensure_writer()
+            self.condition.notify_all()
+        return True
+    def get(self, key):
+        with self.condition:
+            if key in self.pending:
+                value = self.pending[key][0]
+                if isinstance(value, BaseResponse):
+                    return copy_response(value)
+                return value
+        return self.cache.get(key)
+    def add(self, key, value, timeout=None):
+        with self.condition:
+            if key in self.pending:
+                return False
+        return self.cache.add(key, value, timeout)
+    def delete(self, key):
+        with self.condition:
+            self.pending.pop(key, None)
+            if key == self.in_flight:
+                self.deleted_in_flight = True
+        return self.cache.delete(key)
+    def has(self, key):
+        with self.condition:
+            if key in self.pending:
+                return True
+        return self.cache.has(key)
+    def clear(self):
+        with self.condition:
+            self.pending.clear()
+            if self.in_flight is not None:
+                self.deleted_in_flight = True
+        return self.cache.clear()
+    def wait_for(self, key):
+        "Waits for a pending write to key (if any) to be written"
+        with self.condition:
+            while key in self.pending or key == self.in_flight:
+                self.condition.wait()
+    def inc(self, key, delta=1):
+        self.wait_for(key)
+        return self.cache.inc(key, delta)
+    def dec(self, key, delta=1):
+        self.wait_for(key)
+        return self.cache.dec(key, delta)
@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+from time import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+webcache_cli = AppGroup('webcache', help='Inspect and manage the webcache.')
+
+def get_handler():
+    try:
+        return current_app.extensions['webcache']['response']
+    except (AttributeError, KeyError):
+        raise click.ClickException('no webcache ResponseHandler installed')
+
+def get_indexed_resources(handler, prefix, pattern):
+    if not handler.config.resource_index:
+        raise click.ClickException('the resource index is disabled (see '
+                                   "Config's resource_index)")
+    return handler.indexed_resources(prefix, pattern)
+
+def format_entry(resource, entry, now):
+    return '%s\t%d bytes\t%ds left' % (resource, entry['size'],
+                                        max(0, entry['expires'] - now))
+
+@webcache_cli.command('stats')
+def stats_command():
+    "Show cache statistics."
+    handler = get_handler()
+    click.echo('backend: %s' % handler.cache.__class__.__name__)
+    if handler.config.resource_index:
+        resources = handler.indexed_resources()
+        click.echo('resources: %d' % len(resources))
+        click.echo('bytes: %d' % sum(entry['size']
+                                     for entry in resources.values()))
+    for name, extension in sorted(current_app.extensions['webcache'].items()):
+        if hasattr(extension, 'status'):
+            click.echo('%s: %s' % (name, ', '.join(
+                '%s=%s' % item for item in sorted(extension.status().items()))))
+
+@webcache_cli.command('show')
+@click.argument('resource')
+def show_command(resource):
+    "Show the metadata of a resource (a path, with a query if any)."
+    handler = get_handler()
+    metadata = handler.cache.get(handler.metadata_cache_key(resource))
+    if metadata is None:
+        raise click.ClickException('%s is not cached' % resource)
+    click.echo('resource: %s' % resource)
+    click.echo('salt: %s' % metadata.salt)
+    click.echo('vary: %s' % (metadata.vary.to_header() or '-'))
+    if handler.config.resource_index:
+        entry = handler.indexed_resource(resource)
+        if entry is not None:
+            click.echo('size: %d bytes' % entry['size'])
+            click.echo('ttl: %ds' % max(0, entry['expires'] - time()))
+
+@webcache_cli.command('list')
+@click.argument('prefix', default='')
+@click.option('--pattern', help='Only resources matching this glob.')
+def list_command(prefix, pattern):
+    "List cached resources, optionally by prefix or pattern."
+    handler = get_handler()
+    now = time()
+    resources = get_indexed_resources(handler, prefix, pattern)
+    for resource, entry in sorted(resources.items()):
+        click.echo(format_entry(resource, entry, now))
+
+@webcache_cli.command('purge')
+@click.argument('prefix', default='')
+@click.option('--pattern', help='Only resources matching this glob.')
+def purge_command(prefix, pattern):
+    "Invalidate cached resources by prefix and/or pattern."
+    if not prefix and pattern is None:
+        raise click.UsageError('a prefix (use / for everything) or a '
+                               'pattern is required')
+    handler = get_handler()
+    get_indexed_resources(handler, prefix, pattern) # verify index enabled
+    for resource in handler.purge_resources(prefix, pattern):
+        click.echo('purged %s' % resource)
+
+@webcache_cli.command('evict')
+@click.argument('resources', nargs=-1, required=True)
+def evict_command(resources):
+    "Invalidate the given resources (exact paths, with a query if any)."
+    handler = get_handler()
+    for resource in resources:
+        handler.cache.delete(handler.metadata_cache_key(resource))
+        click.echo('evicted %s' % resource)
+    if handler.config.resource_index:
+        handler.unindex_resources(resources)
+
+@webcache_cli.command('warm')
+@click.argument('resources', nargs=-1)
+@click.option('--from-file', type=click.File(), help='Read resources from '
+              'this file, one per line (- for stdin).')
+@click.option('--refresh', is_flag=True, help='Re-render resources even if '
+              'they are cached.')
+def warm_command(resources, from_file, refresh):
+    "Cache the given resources by requesting them."
+    resources = list(resources)
+    if from_file is not None:
+        resources.extend(line.strip() for line in from_file if line.strip())
+    headers = {'Cache-Control': 'no-cache'} if refresh else {}
+    client = current_app.test_client()
+    for resource in resources:
+        response = client.get(resource, headers=headers)
+        click.echo('%s\t%s\t%s' % (resource, response.status_code,
+                                   response.headers.get('X-Cache', '-')))
@@ -1,4 +1,6 @@
 from __future__ import unicode_literals
+from time import time
+
 from flask import g
 
 from . import storage, validation, modifiers
@@ -8,7 +10,7 @@ def register_extension(app, name, obj):
         app.extensions = {}
     app.extensions.setdefault('webcache', {})[name] = obj
 
-class RequestHandler(storage.Retrieval):
+class RequestHandler(validation.Validation, storage.Retrieval):
     def __init__(self, cache, app=None, config=None):
         super(RequestHandler, self).__init__(cache, config)
         if app is not None:
@@ -19,11 +21,29 @@ class RequestHandler(storage.Retrieval):
     def before_request(self):
         modifiers.setup_for_this_request()
         g.webcache_cached_response = False
+        g.webcache_request_started = time()
+        g.webcache_trace = None
+        if self.should_trace():
+            g.webcache_trace = storage.Trace(self.request_path_and_query())
         try:
-            if self.should_fetch_response() and not self.is_exempt():
-                return self.fetch_response()
-        except storage.CacheMiss:
-            pass
+            if not self.should_fetch_response():
+                self.trace_miss('bypass')
+            elif self.is_exempt():
+                self.trace_miss('exempt')
+            else:
+                return self.prepare_cached_response(self.fetch_response())
+        except storage.CacheMiss as e:
+            self.trace_miss(e.__class__.__name__)
+    def trace_miss(self, reason):
+        if g.webcache_trace is not None:
+            g.webcache_trace.miss(reason)
+    def prepare_cached_response(self, response):
+        # cached responses were processed by ResponseHandler before they were
+        #  stored, so all that's left to do is what's specific to this request
+        self.add_age_header(response)
+        if self.if_none_match(response):
+            return self.return_not_modified_response(response) or response
+        return response
 
 class ResponseHandler(validation.Validation, storage.Store):
     def __init__(self, cache, app=None, config=None):
@@ -33,19 +53,40 @@ class ResponseHandler(validation.Validation, storage.Store):
     def init_app(self, app):
         app.after_request(self.after_request)
         register_extension(app, 'response', self)
+        if hasattr(app, 'cli'): # flask>=0.11
+            from .cli import webcache_cli
+            app.cli.add_command(webcache_cli)
     def after_request(self, response):
+        response = self.process_response(response)
+        trace = getattr(g, 'webcache_trace', None)
+        if trace is not None:
+            self.emit_trace(trace, response)
+        return response
+    def process_response(self, response):
+        if g.webcache_cached_response:
+            return response # see RequestHandler.prepare_cached_response
         self.add_date_fields(response)
         for modifier in modifiers.after_request:
             modifier(response)
         if self.can_set_etag(response):
-            self.set_etag(response)
+            with self.trace_stage('etag'):
+                self.set_etag(response)
         if self.if_none_match(response):
             return self.return_not_modified_response(response) or response
-        if g.webcache_cached_response:
-            return response
         if self.should_cache_response(response) and not self.is_exempt():
-            self.cache_response(response)
+            with self.trace_stage('store'):
+                self.cache_response(response)
             self.mark_cache_miss(response)
         elif self.should_invalidate_resource(response):
             self.invalidate_resource()
         return response
+    def emit_trace(self, trace, response):
+        trace.outcome = response.headers.get(self.X_CACHE_HEADER or '',
+                                             'uncached')
+        if self.config.trace_headers:
+            if trace.stages:
+                response.headers.add('Server-Timing', trace.server_timing())
+            if self.X_CACHE_HEADER:
+                response.headers[self.X_CACHE_HEADER] = trace.x_cache()
+        if self.config.trace_callback is not None:
+            self.config.trace_callback(trace)
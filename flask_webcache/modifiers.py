@@ -3,7 +3,7 @@ from datetime import timedelta, datetime
 from functools import wraps
 from six import iteritems
 
-from flask import _request_ctx_stack
+from flask import _request_ctx_stack, request
 from werkzeug.datastructures import ResponseCacheControl
 from werkzeug.local import LocalProxy
 
@@ -45,3 +45,25 @@ class cache_control(BaseModifier):
     def modify_response(self, response):
         for key, value in iteritems(self.kwargs):
             setattr(response.cache_control, key, value)
+
+class revalidate_with(BaseModifier):
+    """Modifier that registers a cheap provider of the current version of a
+       resource (say, its last modification time), called with the view's
+       arguments. Stale cached representations whose stored version matches
+       the provider's are refreshed rather than re-rendered (see Config's
+       revalidation_seconds)"""
+    def __init__(self, provider):
+        self.provider = provider
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            # version is taken before rendering, so changes made while
+            #  rendering are seen on the next revalidation
+            version = self.provider(**request.view_args)
+            after_request.append(lambda response:
+                                 self.modify_response(response, version))
+            return func(*args, **kwargs)
+        inner.webcache_version_provider = self.provider
+        return inner
+    def modify_response(self, response, version=None):
+        response.webcache_version = version
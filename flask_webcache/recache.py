@@ -1,11 +1,23 @@
 from __future__ import unicode_literals
+from collections import deque
+from heapq import nlargest
+from threading import Lock
+from time import time
+
 from flask import request, current_app
-from werkzeug.http import Headers
+from werkzeug.datastructures import Headers
 
 RECACHE_HEADER = 'X-Webcache-Recache'
 
-def get_dispatch_args(app_factory, salt):
-    headers = Headers(request.headers)
+def get_dispatch_args(app_factory, salt, vary=None):
+    # with vary, only the headers selecting the representation are kept
+    #  (and Host), rather than all of this client's (e.g. its Cookie)
+    if vary is None:
+        headers = Headers(request.headers)
+    else:
+        headers = Headers([(name, request.headers[name])
+                           for name in ['Host'] + list(vary)
+                           if name in request.headers])
     headers[RECACHE_HEADER] = salt
     return (app_factory, request.method, request.path, request.query_string,
             headers)
@@ -46,9 +58,151 @@ def make_process_dispatcher(app_factory=None):
 
 def dispatch_request(app_factory, method, path, query_string, headers):
     app = app_factory() if callable(app_factory) else current_app
-    app.test_client().open(
+    return app.test_client().open(
         method = method,
         path = path,
         query_string = query_string,
         headers = headers,
     )
+
+class ScheduledResource(object):
+    def __init__(self, args, now):
+        self.args = args
+        self.popularity = 0.0
+        self.last_hit = now
+        self.render_seconds = None
+        self.expires = None
+        self.dispatched = None
+
+class RecacheScheduler(object):
+    """Proactively recaches popular resources shortly before they expire.
+
+       Hits and renders are recorded by the handlers (see Config's
+       recache_scheduler); tick() should be called periodically (start()
+       does so from a background thread). On every tick, the `top` most
+       valuable resources (by decaying hit count times render duration)
+       which expire within `lead_seconds` are recached, at most
+       `renders_per_second` on average. Resources with a decayed hit count
+       below `min_hits` are left to expire and eventually forgotten.
+
+       Only rendered resources are tracked; their dispatch arguments are
+       taken when they're rendered. Hits are just queued, without locking,
+       and counted on the next tick (beyond `max_pending_hits`, the oldest
+       queued hits are dropped).
+
+       `dispatch` is called with dispatch_request()'s arguments, and by
+       default calls it in the calling thread (e.g., use
+       `lambda args: queue.enqueue_call(dispatch_request, args=args)` for rq)."""
+    DEFAULT_RENDER_SECONDS = 0.001
+    def __init__(self, app_factory=None, dispatch=None, top=100,
+                 renders_per_second=1.0, lead_seconds=10,
+                 half_life_seconds=300, min_hits=2, max_tracked=10000,
+                 max_pending_hits=100000):
+        self.app_factory = app_factory
+        self.app = None
+        self.dispatch = dispatch or self.dispatch_here
+        self.top = top
+        self.renders_per_second = renders_per_second
+        self.lead_seconds = lead_seconds
+        self.half_life_seconds = half_life_seconds
+        self.min_hits = min_hits
+        self.max_tracked = max_tracked
+        self.resources = {}
+        self.hits = deque(maxlen=max_pending_hits)
+        self.lock = Lock()
+        self.tokens = max(1.0, renders_per_second)
+        self.last_tick = None
+    def dispatch_here(self, args):
+        if self.app is None:
+            return dispatch_request(*args)
+        with self.app.app_context():
+            return dispatch_request(*args)
+    def decayed(self, resource, now):
+        elapsed = max(0, now - resource.last_hit)
+        return resource.popularity * 2 ** (-elapsed / self.half_life_seconds)
+    def record_hit(self, key, freshness, now=None):
+        # called on every cache hit, so deque.append's atomicity is relied
+        #  upon rather than taking the lock
+        self.hits.append((key, freshness, time() if now is None else now))
+    def count_hits(self):
+        while True:
+            try:
+                key, freshness, now = self.hits.popleft()
+            except IndexError:
+                return
+            resource = self.resources.get(key)
+            if resource is None:
+                continue # forgotten, or rendered before the scheduler ran
+            resource.popularity = self.decayed(resource, now) + 1
+            resource.last_hit = max(resource.last_hit, now)
+            resource.expires = now + freshness
+    def record_render(self, key, salt, render_seconds, expiry_seconds,
+                      vary=None, now=None):
+        now = time() if now is None else now
+        if self.app_factory is None:
+            self.app = current_app._get_current_object()
+        args = get_dispatch_args(self.app_factory, salt, vary)
+        with self.lock:
+            resource = self.resources.get(key)
+            if resource is None:
+                resource = self.resources[key] = ScheduledResource(args, now)
+            resource.args = args
+            if render_seconds is not None:
+                resource.render_seconds = render_seconds
+            resource.expires = now + expiry_seconds
+            resource.dispatched = None
+    def score(self, resource, now):
+        render_seconds = resource.render_seconds or self.DEFAULT_RENDER_SECONDS
+        return self.decayed(resource, now) * render_seconds
+    def forget_lapsed(self, now):
+        for key, resource in list(self.resources.items()):
+            if (resource.expires < now and
+                self.decayed(resource, now) < self.min_hits):
+                del self.resources[key]
+        excess = len(self.resources) - self.max_tracked
+        if excess > 0:
+            coldest = sorted(self.resources,
+                             key=lambda k: self.decayed(self.resources[k], now))
+            for key in coldest[:excess]:
+                del self.resources[key]
+    def due(self, now):
+        candidates = [
+            resource for resource in self.resources.values()
+            if resource.dispatched != resource.expires and
+               now < resource.expires <= now + self.lead_seconds and
+               self.decayed(resource, now) >= self.min_hits
+        ]
+        return nlargest(self.top, candidates,
+                        key=lambda resource: self.score(resource, now))
+    def tick(self, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            if self.last_tick is not None:
+                self.tokens = min(max(1.0, self.renders_per_second),
+                                  self.tokens + (now - self.last_tick) *
+                                  self.renders_per_second)
+            self.last_tick = now
+            self.count_hits()
+            self.forget_lapsed(now)
+            dispatching = []
+            for resource in self.due(now):
+                if self.tokens < 1:
+                    break
+                self.tokens -= 1
+                resource.dispatched = resource.expires
+                dispatching.append(resource.args)
+        for args in dispatching:
+            self.dispatch(args)
+        return len(dispatching)
+    def start(self, interval=1.0):
+        from threading import Thread, Event
+        self.stopped = Event()
+        def run():
+            while not self.stopped.wait(interval):
+                self.tick()
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+    def stop(self):
+        self.stopped.set()
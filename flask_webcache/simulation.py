@@ -0,0 +1,209 @@
+"""
+simulation - replays workloads through webcache handlers to tune cache policies
+
+Requests (recorded from an access log or generated from a Zipf distribution) are dispatched with a test client, like
+recache.dispatch_request does, to an app with webcache handlers installed, while the clocks webcache uses follow the
+requests' timestamps. Every storage.Config variant gets its own app and cache, and the results are reported side by
+side: hit ratio, byte hit ratio, renders saved and the number of cache backend operations.
+
+Logs are JSON lines, each a request like {"time": 1388000000.5, "method": "GET", "path": "/foo", "query": "a=1",
+"headers": {"Accept-Encoding": "gzip"}} (all but time and path are optional). From the command line:
+    % python -m flask_webcache.simulation --app myapp:create_app --zipf 100000 \\
+          --config default={} --config negative='{"negative_caching": true}'
+where create_app returns an app without webcache handlers (they're installed by the simulation).
+"""
+from __future__ import division, print_function, unicode_literals
+from bisect import bisect
+from collections import Counter
+from datetime import datetime
+from importlib import import_module
+from random import Random
+from time import time as real_time
+import json
+import sys
+
+from werkzeug.contrib.cache import BaseCache
+from werkzeug.datastructures import Headers
+
+from . import backends, handlers, modifiers, recache, storage, validation
+
+class SimulatedClock(object):
+    """Makes webcache's modules see simulated time while used as a context.
+
+       Simulated time is the time last set() plus the real time since, so
+       measured durations (like render times) are still meaningful."""
+    TIME_MODULES = (storage, handlers, backends, recache)
+    DATETIME_MODULES = (storage, validation, modifiers)
+    def __init__(self, now=0):
+        self.set(now)
+        self.originals = []
+    def set(self, now):
+        self.now = now
+        self.anchor = real_time()
+    def __call__(self):
+        return self.now + real_time() - self.anchor
+    def __enter__(self):
+        clock = self
+        class SimulatedDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return datetime.utcfromtimestamp(clock())
+        for module in self.TIME_MODULES:
+            self.originals.append((module, 'time', module.time))
+            module.time = self
+        for module in self.DATETIME_MODULES:
+            self.originals.append((module, 'datetime', module.datetime))
+            module.datetime = SimulatedDatetime
+        return self
+    def __exit__(self, *exc_info):
+        while self.originals:
+            module, name, original = self.originals.pop()
+            setattr(module, name, original)
+
+class CountingCache(BaseCache):
+    "Wraps a cache, counting the operations made on it"
+    OPERATIONS = ('get', 'get_many', 'set', 'add', 'set_many', 'delete',
+                  'delete_many', 'has', 'clear', 'inc', 'dec')
+    def __init__(self, cache):
+        BaseCache.__init__(self, cache.default_timeout)
+        self.cache = cache
+        self.operations = Counter()
+
+def make_counted_operation(name):
+    def operation(self, *args, **kwargs):
+        self.operations[name] += 1
+        return getattr(self.cache, name)(*args, **kwargs)
+    operation.__name__ = str(name)
+    return operation
+for name in CountingCache.OPERATIONS:
+    setattr(CountingCache, name, make_counted_operation(name))
+
+class Report(object):
+    def __init__(self, name):
+        self.name = name
+        self.requests = self.hits = 0
+        self.bytes = self.hit_bytes = 0
+        self.operations = Counter()
+    def record(self, response):
+        size = len(response.get_data())
+        self.requests += 1
+        self.bytes += size
+        if response.headers.get(storage.Base.X_CACHE_HEADER) == 'hit':
+            self.hits += 1
+            self.hit_bytes += size
+    @property
+    def renders(self):
+        return self.requests - self.hits
+    @property
+    def hit_ratio(self):
+        return self.hits / self.requests if self.requests else 0
+    @property
+    def byte_hit_ratio(self):
+        return self.hit_bytes / self.bytes if self.bytes else 0
+    @property
+    def backend_operations(self):
+        return sum(self.operations.values())
+
+def with_handlers(make_app):
+    """Turns a factory of apps without webcache handlers into one taking a
+       cache and a config, as replay() expects"""
+    def app_factory(cache, config):
+        app = make_app()
+        handlers.RequestHandler(cache, app, config)
+        handlers.ResponseHandler(cache, app, config)
+        return app
+    return app_factory
+
+def replay(app_factory, log, config=None, cache=None, name='default'):
+    """Replays requests through a new app made by app_factory(cache, config)
+       on a simulated clock; returns a Report"""
+    report = Report(name)
+    cache = CountingCache(cache or backends.MemoryCache())
+    app = app_factory(cache, config or storage.Config())
+    with SimulatedClock(log[0]['time'] if log else 0) as clock:
+        for entry in log:
+            clock.set(entry['time'])
+            response = recache.dispatch_request(
+                lambda: app, entry.get('method', 'GET'), entry['path'],
+                entry.get('query', ''), Headers(entry.get('headers', {})))
+            report.record(response)
+    report.operations = cache.operations
+    return report
+
+def compare(app_factory, log, configs):
+    "Replays a log for every named config; returns a list of Reports"
+    return [replay(app_factory, log, config, name=name)
+            for name, config in sorted(configs.items())]
+
+def format_reports(reports):
+    rows = [
+        ('', lambda r: r.name),
+        ('requests', lambda r: '%d' % r.requests),
+        ('hit ratio', lambda r: '%.1f%%' % (r.hit_ratio * 100)),
+        ('byte hit ratio', lambda r: '%.1f%%' % (r.byte_hit_ratio * 100)),
+        ('renders', lambda r: '%d' % r.renders),
+        ('renders saved', lambda r: '%d' % r.hits),
+        ('backend operations', lambda r: '%d' % r.backend_operations),
+    ]
+    width = max([len(r.name) for r in reports] + [10]) + 2
+    return '\n'.join(
+        '%-20s' % title + ''.join(fmt(r).rjust(width) for r in reports)
+        for title, fmt in rows
+    )
+
+def zipf_workload(requests=10000, resources=1000, exponent=1.0, rate=100.0,
+                  path='/%d', start=0, seed=None):
+    """Generates a log of GET requests for resources whose popularity follows
+       a Zipf distribution, arriving as a Poisson process of `rate` per
+       second"""
+    random = Random(seed)
+    cumulative, total = [], 0
+    for rank in range(1, resources + 1):
+        total += 1 / rank ** exponent
+        cumulative.append(total)
+    log, now = [], start
+    for i in range(requests):
+        now += random.expovariate(rate)
+        rank = bisect(cumulative, random.random() * total) + 1
+        log.append(dict(time=now, method='GET', path=path % min(rank, resources)))
+    return log
+
+def read_log(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+def load_object(spec):
+    module, name = spec.split(':', 1)
+    return getattr(import_module(module), name)
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Compare webcache configs on a workload.')
+    parser.add_argument('--app', required=True, help='module:factory of an app '
+                        'without webcache handlers')
+    workload = parser.add_mutually_exclusive_group(required=True)
+    workload.add_argument('--log', help='JSON lines access log (- for stdin)')
+    workload.add_argument('--zipf', type=int, help='generate this many requests')
+    parser.add_argument('--resources', type=int, default=1000)
+    parser.add_argument('--exponent', type=float, default=1.0)
+    parser.add_argument('--rate', type=float, default=100.0)
+    parser.add_argument('--path', default='/%d')
+    parser.add_argument('--config', action='append', default=[],
+                        help='name=JSON of storage.Config arguments')
+    args = parser.parse_args(argv)
+    if args.log == '-':
+        log = read_log(sys.stdin)
+    elif args.log:
+        with open(args.log) as f:
+            log = read_log(f)
+    else:
+        log = zipf_workload(args.zipf, args.resources, args.exponent,
+                            args.rate, args.path)
+    configs = {}
+    for spec in args.config or ['default={}']:
+        name, kwargs = spec.split('=', 1)
+        configs[name] = storage.Config(**json.loads(kwargs))
+    reports = compare(with_handlers(load_object(args.app)), log, configs)
+    print(format_reports(reports))
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,18 @@
 from __future__ import unicode_literals
 from datetime import datetime
+from fnmatch import fnmatchcase
+from math import log
+from random import random
+from time import time
 import hashlib
 
-from flask import request, g
+from six import integer_types
+from six.moves.http_client import NOT_FOUND, GONE, MOVED_PERMANENTLY
+from flask import request, g, current_app
 from werkzeug.datastructures import parse_set_header
 
 from .utils import (make_salt, effective_max_age, none_or_truthy,
-                    werkzeug_cache_get_or_add)
+                    werkzeug_cache_get_or_add, copy_response, utc_timestamp)
 from .recache import RECACHE_HEADER
 
 class CacheMiss(Exception): pass
@@ -14,16 +20,30 @@ class NoResourceMetadata(CacheMiss): pass
 class NoMatchingRepresentation(CacheMiss): pass
 class NotFreshEnoughForClient(CacheMiss): pass
 class RecacheRequested(CacheMiss): pass
+class StaleRepresentation(CacheMiss): pass
 
 class Config(object):
     def __init__(self, resource_exemptions=(), master_salt='',
                  request_controls_cache=True, preemptive_recache_seconds=0,
-                 preemptive_recache_callback=None):
+                 preemptive_recache_callback=None, negative_caching=False,
+                 redirect_caching=False, status_expiration_seconds=None,
+                 recache_scheduler=None, revalidation_seconds=0,
+                 resource_index=False, preemptive_recache_beta=None,
+                 trace_headers=False, trace_callback=None):
         self.resource_exemptions = resource_exemptions
         self.master_salt = master_salt
         self.request_controls_cache = request_controls_cache
         self.preemptive_recache_seconds = preemptive_recache_seconds
         self.preemptive_recache_callback = preemptive_recache_callback
+        self.negative_caching = negative_caching
+        self.redirect_caching = redirect_caching
+        self.status_expiration_seconds = status_expiration_seconds or {}
+        self.recache_scheduler = recache_scheduler
+        self.revalidation_seconds = revalidation_seconds
+        self.resource_index = resource_index
+        self.preemptive_recache_beta = preemptive_recache_beta
+        self.trace_headers = trace_headers
+        self.trace_callback = trace_callback
 
 class Metadata(object):
     def __init__(self, vary, salt):
@@ -40,13 +60,65 @@ class Metadata(object):
         except AttributeError:
             return False
 
+class Trace(object):
+    "What webcache did for a request, stage by stage; see Config.trace_*"
+    def __init__(self, resource):
+        self.resource = resource
+        self.stages = [] # (name, seconds) in the order they were run
+        self.outcome = None # the X-Cache value, or 'uncached'
+        self.reason = None # why there was no hit, if there wasn't
+    def stage(self, name):
+        return TraceStage(self, name)
+    def miss(self, reason):
+        if self.reason is None:
+            self.reason = reason
+    def server_timing(self):
+        return ', '.join('webcache-%s;dur=%.3f' % (name, seconds * 1000)
+                         for name, seconds in self.stages)
+    def x_cache(self):
+        rv = self.outcome
+        if self.reason is not None:
+            rv += '; reason=' + self.reason
+        return rv
+
+class TraceStage(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+    def __enter__(self):
+        self.started = time()
+    def __exit__(self, exc_type, exc_value, tb):
+        self.trace.stages.append((self.name, time() - self.started))
+        if exc_type is not None and issubclass(exc_type, CacheMiss):
+            self.trace.miss(exc_type.__name__)
+
+class UntracedStage(object):
+    def __enter__(self): pass
+    def __exit__(self, exc_type, exc_value, tb): pass
+UNTRACED_STAGE = UntracedStage()
+
 class Base(object):
     X_CACHE_HEADER = 'X-Cache'
     CACHE_SEPARATOR = ':'
     DEFAULT_EXPIRATION_SECONDS = 300
+    NEGATIVE_EXPIRATION_SECONDS = {NOT_FOUND: 60, GONE: 60}
+    REDIRECT_EXPIRATION_SECONDS = {MOVED_PERMANENTLY: 120}
+    INDEX_RETENTION_SECONDS = 3600
     def __init__(self, cache, config=None):
         self.cache = cache
         self.config = config or Config()
+    def status_expiration_seconds(self, status_code):
+        if status_code in self.config.status_expiration_seconds:
+            return self.config.status_expiration_seconds[status_code]
+        if str(status_code)[0] == '2':
+            return self.DEFAULT_EXPIRATION_SECONDS
+        if self.config.negative_caching:
+            if status_code in self.NEGATIVE_EXPIRATION_SECONDS:
+                return self.NEGATIVE_EXPIRATION_SECONDS[status_code]
+        if self.config.redirect_caching:
+            if status_code in self.REDIRECT_EXPIRATION_SECONDS:
+                return self.REDIRECT_EXPIRATION_SECONDS[status_code]
+        return 0 # see 13.4
     def request_path_and_query(self):
         if request.query_string:
             return '?'.join((request.path, request.query_string.decode('utf-8')))
@@ -61,12 +133,78 @@ class Base(object):
         ctx.update(self.config.master_salt.encode('utf-8'))
         return self.make_key(namespace, ctx.hexdigest(),
                              self.request_path_and_query())
-    def metadata_cache_key(self):
-        return self.make_key('metadata', self.request_path_and_query())
+    def metadata_cache_key(self, resource=None):
+        return self.make_key('metadata',
+                             resource or self.request_path_and_query())
     def response_cache_key(self, metadata):
         return self.make_response_key('representation', metadata)
     def recache_cache_key(self, metadata):
         return self.make_response_key('recache', metadata)
+    def index_cache_key(self, kind, *bits):
+        # every resource has an entry of its own (see indexed_cache_key), and
+        #  is listed in a numbered slot of its first path segment; segments
+        #  are listed in numbered root slots, so prefix scans only read the
+        #  slots they need. a segment's slots belong to a generation, which
+        #  ends (and so restarts numbering) once all its entries expired
+        return self.make_key('index-' + kind, *bits)
+    def indexed_cache_key(self, resource):
+        return self.make_key('indexed', resource)
+    def index_segment(self, resource):
+        return resource.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+    def indexed_resource(self, resource):
+        entry = self.cache.get(self.indexed_cache_key(resource))
+        if entry is None or entry['expires'] <= time():
+            return None
+        return entry
+    def read_index_slots(self, counter, make_key):
+        count = self.cache.get(counter)
+        if not isinstance(count, integer_types) or count < 1:
+            return set()
+        keys = [make_key(str(n)) for n in range(1, count + 1)]
+        return set(self.cache.get_many(*keys)) - {None}
+    def indexed_segments(self):
+        return self.read_index_slots(
+            self.index_cache_key('segments'),
+            lambda n: self.index_cache_key('root', n))
+    def segment_resources(self, segment):
+        generation = self.cache.get(self.index_cache_key('generation', segment))
+        if generation is None:
+            return set()
+        return self.read_index_slots(
+            self.index_cache_key('slots', generation['id'], segment),
+            lambda n: self.index_cache_key('slot', generation['id'], n,
+                                           segment))
+    def indexed_resources(self, prefix='', pattern=None):
+        segments = self.indexed_segments()
+        stripped = prefix.lstrip('/')
+        if '/' in stripped or '?' in stripped:
+            segments = segments & {self.index_segment(prefix)}
+        else:
+            segments = [s for s in segments if s.startswith(stripped)]
+        resources = []
+        for segment in segments:
+            for resource in self.segment_resources(segment):
+                if not resource.startswith(prefix):
+                    continue
+                if pattern is not None and not fnmatchcase(resource, pattern):
+                    continue
+                resources.append(resource)
+        if not resources:
+            return {}
+        now = time()
+        entries = self.cache.get_many(*[self.indexed_cache_key(resource)
+                                        for resource in resources])
+        return dict((resource, entry)
+                    for resource, entry in zip(resources, entries)
+                    if entry is not None and entry['expires'] > now)
+    def should_trace(self):
+        return (self.config.trace_headers or
+                self.config.trace_callback is not None)
+    def trace_stage(self, name):
+        trace = getattr(g, 'webcache_trace', None)
+        if trace is None:
+            return UNTRACED_STAGE
+        return trace.stage(name)
     def get_or_miss(self, key, exception):
         result = self.cache.get(key)
         if result is None:
@@ -77,6 +215,9 @@ class Base(object):
             if request.path.startswith(prefix):
                 return True
         return False
+    def set_date_timestamp(self, response):
+        date = response.date
+        response.webcache_date = None if date is None else utc_timestamp(date)
 
 class Retrieval(Base):
     def should_fetch_response(self):
@@ -94,18 +235,32 @@ class Retrieval(Base):
         return True
     def fetch_metadata(self):
         key = self.metadata_cache_key()
-        return self.get_or_miss(key, NoResourceMetadata)
+        with self.trace_stage('metadata'):
+            return self.get_or_miss(key, NoResourceMetadata)
     def fetch_response(self):
         metadata = self.fetch_metadata()
         if request.headers.get(RECACHE_HEADER) == metadata.salt:
             raise RecacheRequested()
         g.webcache_cache_metadata = metadata
         key = self.response_cache_key(metadata)
-        response = self.get_or_miss(key, NoMatchingRepresentation)
-        freshness = self.response_freshness_seconds(response)
-        self.verify_response_freshness_or_miss(response, freshness)
-        if self.should_recache_preemptively(freshness, metadata):
+        # NOTE: werkzeug's caches deserialize in get(), so that's included
+        with self.trace_stage('representation'):
+            response = self.get_or_miss(key, NoMatchingRepresentation)
+        with self.trace_stage('freshness'):
+            freshness = self.response_freshness_seconds(response)
+            if self.config.revalidation_seconds and not freshness:
+                self.revalidate_response_or_miss(key, response)
+                freshness = self.response_freshness_seconds(response)
+            self.verify_response_freshness_or_miss(response, freshness)
+        if self.config.preemptive_recache_beta is not None:
+            recache = self.should_recache_probabilistically(freshness,
+                                                            response)
+        else:
+            recache = self.should_recache_preemptively(freshness, metadata)
+        if recache:
             self.config.preemptive_recache_callback(metadata.salt)
+        if self.config.recache_scheduler is not None:
+            self.config.recache_scheduler.record_hit(key, freshness)
         g.webcache_cached_response = True
         return response
     def response_freshness_seconds(self, response):
@@ -114,15 +269,43 @@ class Retrieval(Base):
             age = (now - response.date).total_seconds()
         else:
             age = None
-        if 'max-age' in response.cache_control and age:
-            rv = response.cache_control.max_age - age
+        max_age = effective_max_age(response)
+        if max_age is not None and age:
+            rv = max_age - age
         elif response.expires:
             rv = (response.expires - now).total_seconds()
         elif age:
-            rv = self.DEFAULT_EXPIRATION_SECONDS - age
+            rv = self.status_expiration_seconds(response.status_code) - age
         else:
             rv = 0 # should never happen for cached responses
         return max(0, rv)
+    def version_provider(self):
+        if request.url_rule is None:
+            return None
+        view = current_app.view_functions.get(request.url_rule.endpoint)
+        return getattr(view, 'webcache_version_provider', None)
+    def revalidate_response_or_miss(self, key, response):
+        # stale representations are kept around for revalidation_seconds if
+        #  their view has a version provider (see modifiers.revalidate_with)
+        provider = self.version_provider()
+        version = getattr(response, 'webcache_version', None)
+        if (provider is None or version is None or
+            provider(**(request.view_args or {})) != version):
+            raise StaleRepresentation()
+        now = datetime.utcnow()
+        if response.expires and response.date:
+            response.expires = now + (response.expires - response.date)
+        response.date = now
+        self.set_date_timestamp(response)
+        freshness = self.response_freshness_seconds(response)
+        self.cache.set(key, response,
+                       freshness + self.config.revalidation_seconds)
+    def add_age_header(self, response):
+        # shared caches must send Age (see 13.2.3 & 14.6); the date of stored
+        #  responses is kept as a timestamp so hits needn't parse it
+        date = getattr(response, 'webcache_date', None)
+        if date is not None:
+            response.headers['Age'] = str(max(0, int(time() - date)))
     def verify_response_freshness_or_miss(self, response, freshness):
         if not self.config.request_controls_cache:
             return
@@ -145,12 +328,24 @@ class Retrieval(Base):
             return False
         return True
 
+    def should_recache_probabilistically(self, freshness, response):
+        # probabilistic early expiration ("XFetch"): every request decides
+        #  on its own, with a probability rising as expiry nears, faster for
+        #  responses which took longer to render; no locking needed
+        if self.config.preemptive_recache_callback is None:
+            return False
+        render_seconds = getattr(response, 'webcache_render_seconds', None)
+        if not render_seconds:
+            return False
+        beta = self.config.preemptive_recache_beta
+        return -render_seconds * beta * log(1 - random()) >= freshness
+
 class Store(Base):
     def should_cache_response(self, response):
         if (response.is_streamed or # theoretically possible yet unimplemented
             response._on_close or # _on_close hooks are often unpickleable
             request.method != "GET" or # arbitrarily seems safer to me
-            str(response.status_code)[0] != '2' or # see 13.4 & 14.9.1
+            not self.status_expiration_seconds(response.status_code) or # see 13.4
             '*' in response.vary): # see 14.44
             return False
         if (self.config.request_controls_cache and
@@ -158,42 +353,84 @@ class Store(Base):
             return False
         if 'cache-control' in response.headers: # see 14.9.1
             return (
-                'private' not in response.cache_control and
-                'no-cache' not in response.cache_control and
+                response.cache_control.private != '*' and
+                response.cache_control.no_cache != '*' and
                 'no-store' not in response.cache_control and
                 none_or_truthy(effective_max_age(response))
             )
-            # FIXME: we ignore field-specific "private" and "no-cache" :(
         if 'expires' in response.headers: # see 14.21
             return response.expires > datetime.utcnow()
         if request.args:
             return False # see 13.9
         return True
     def response_expiry_seconds(self, response):
-        if response.cache_control.max_age is not None:
-            return response.cache_control.max_age
+        max_age = effective_max_age(response) # see 14.9.3
+        if max_age is not None:
+            return max_age
         if response.expires:
             return (response.expires - datetime.utcnow()).total_seconds()
-        return self.DEFAULT_EXPIRATION_SECONDS
+        return self.status_expiration_seconds(response.status_code)
+    def retention_seconds(self, response, expiry_seconds):
+        if getattr(response, 'webcache_version', None) is None:
+            return expiry_seconds
+        return expiry_seconds + self.config.revalidation_seconds
     def get_or_create_metadata(self, response, expiry_seconds):
         try:
             return g.webcache_cache_metadata
         except AttributeError:
-            new = Metadata(response.vary, make_salt())
+            # a detached copy, as response.vary's on_update holds the response
+            #  (and caches like MemoryCache store by reference)
+            vary = parse_set_header(response.vary.to_header())
+            new = Metadata(vary, make_salt())
             key = self.metadata_cache_key()
             return werkzeug_cache_get_or_add(self.cache, key, new,
                                              expiry_seconds)
+    def field_specific_headers(self, response):
+        # field-specific "private" and "no-cache" let us store the response,
+        #  as long as we don't store the named headers (see 14.9.1)
+        rv = set()
+        for directive in (response.cache_control.private,
+                          response.cache_control.no_cache):
+            if directive and directive != '*':
+                rv.update(parse_set_header(directive).as_set())
+        return rv
+    def make_storable_response(self, response):
+        headers = self.field_specific_headers(response)
+        if not headers:
+            return response
+        rv = copy_response(response) # the client should still get these
+        for header in headers:
+            del rv.headers[header]
+        return rv
     def store_response(self, metadata, response, expiry_seconds):
         key = self.response_cache_key(metadata)
         response.freeze()
-        self.cache.set(key, response, expiry_seconds)
+        self.set_date_timestamp(response)
+        self.cache.set(key, self.make_storable_response(response),
+                       expiry_seconds)
     def cache_response(self, response):
         expiry_seconds = self.response_expiry_seconds(response)
-        metadata = self.get_or_create_metadata(response, expiry_seconds)
+        retention_seconds = self.retention_seconds(response, expiry_seconds)
+        metadata = self.get_or_create_metadata(response, retention_seconds)
         # TODO: warn when metadata.vary != response.vary?
         self.mark_cache_hit(response)
-        self.store_response(metadata, response, expiry_seconds)
+        response.webcache_render_seconds = self.render_seconds()
+        self.store_response(metadata, response, retention_seconds)
         self.delete_recache_key(metadata)
+        if self.config.resource_index:
+            self.index_resource(self.request_path_and_query(),
+                                retention_seconds,
+                                response.calculate_content_length() or 0)
+        if self.config.recache_scheduler is not None:
+            self.config.recache_scheduler.record_render(
+                self.response_cache_key(metadata), metadata.salt,
+                response.webcache_render_seconds, expiry_seconds,
+                metadata.vary)
+    def render_seconds(self):
+        started = getattr(g, 'webcache_request_started', None)
+        if started is None:
+            return None
+        return time() - started
     def delete_recache_key(self, metadata):
         self.cache.delete(self.recache_cache_key(metadata))
     def mark_cache_hit(self, response):
@@ -210,3 +447,106 @@ class Store(Base):
         return True # see 13.10
     def invalidate_resource(self):
         self.cache.delete(self.metadata_cache_key())
+        if self.config.resource_index:
+            self.unindex_resources([self.request_path_and_query()])
+    def index_resource(self, resource, expiry_seconds, size):
+        # a constant number of cache operations, whatever the index's size;
+        #  entries (and their slots) are kept INDEX_RETENTION_SECONDS after
+        #  expiring, so resources stored again keep their slot
+        # NOTE: cache failures make a resource go unindexed until it's stored
+        #  again; the index is meant for management only
+        now = time()
+        retention = expiry_seconds + self.INDEX_RETENTION_SECONDS
+        segment = self.index_segment(resource)
+        generation = self.extend_index_generation(segment, now + retention)
+        if generation is None:
+            return
+        key = self.indexed_cache_key(resource)
+        entry = self.cache.get(key)
+        slot = None
+        if entry is not None and entry.get('generation') == generation:
+            slot = entry['slot']
+            if not self.keep_index_slot(segment, generation, slot, resource,
+                                        retention):
+                slot = None
+        if slot is None:
+            slot = self.claim_index_slot(segment, generation, resource,
+                                         retention)
+            if slot is None:
+                return
+        self.cache.set(key, dict(stored=now, expires=now + expiry_seconds,
+                                 size=size, generation=generation, slot=slot),
+                       retention)
+    def extend_index_generation(self, segment, expires):
+        now = time()
+        key = self.index_cache_key('generation', segment)
+        generation = self.cache.get(key)
+        if generation is None:
+            # extended by a retention period, so most stores needn't extend it
+            new = dict(id=make_salt(64),
+                       expires=expires + self.INDEX_RETENTION_SECONDS)
+            if self.cache.add(key, new, new['expires'] - now):
+                self.start_index_generation(segment, new['id'])
+                return new['id']
+            generation = self.cache.get(key) # added concurrently
+            if generation is None:
+                return None
+        if generation['expires'] < expires:
+            generation = dict(generation,
+                              expires=expires + self.INDEX_RETENTION_SECONDS)
+            self.cache.set(key, generation, generation['expires'] - now)
+        return generation['id']
+    def start_index_generation(self, segment, generation):
+        # the marker remembers the segment's last generation, whose counter
+        #  is dropped, and that the segment is already listed in the root
+        marker = self.index_cache_key('segment', segment)
+        previous = self.cache.get(marker)
+        if previous is not None:
+            self.cache.delete(self.index_cache_key('slots', previous, segment))
+        elif not self.claim_index_slot_with(
+                self.index_cache_key('segments'),
+                lambda n: self.index_cache_key('root', n), segment, 0):
+            return
+        self.cache.set(marker, generation, 0)
+    def claim_index_slot(self, segment, generation, resource, timeout):
+        return self.claim_index_slot_with(
+            self.index_cache_key('slots', generation, segment),
+            lambda n: self.index_cache_key('slot', generation, n, segment),
+            resource, timeout)
+    def claim_index_slot_with(self, counter, make_key, value, timeout):
+        # slots are claimed with add(), so a counter that was lost (and so
+        #  counts again from 1) can't make resources overwrite each other
+        for attempt in range(3):
+            slot = self.cache.inc(counter)
+            if slot is None: # memcached doesn't increment missing keys
+                self.cache.add(counter, 0, 0)
+                slot = self.cache.inc(counter)
+            if not isinstance(slot, integer_types):
+                return None
+            if self.cache.add(make_key(str(slot)), value, timeout):
+                return slot
+        return None
+    def keep_index_slot(self, segment, generation, slot, resource, timeout):
+        key = self.index_cache_key('slot', generation, str(slot), segment)
+        current = self.cache.get(key)
+        if current is None:
+            return self.cache.add(key, resource, timeout)
+        if current != resource:
+            return False
+        return self.cache.set(key, resource, timeout)
+    def unindex_resources(self, resources):
+        # entries are kept (as expired), so stored again they keep their slot
+        resources = list(resources)
+        if not resources:
+            return
+        keys = [self.indexed_cache_key(resource) for resource in resources]
+        for key, entry in zip(keys, self.cache.get_many(*keys)):
+            if entry is not None and entry['expires']:
+                self.cache.set(key, dict(entry, expires=0),
+                               self.INDEX_RETENTION_SECONDS)
+    def purge_resources(self, prefix='', pattern=None):
+        resources = sorted(self.indexed_resources(prefix, pattern))
+        for resource in resources:
+            self.cache.delete(self.metadata_cache_key(resource))
+        self.unindex_resources(resources)
+        return resources
@@ -1,12 +1,18 @@
 from __future__ import unicode_literals
 from random import getrandbits
+from calendar import timegm
+from copy import copy
 
 def make_salt(bits=128):
     return hex(getrandbits(bits))
 
 def effective_max_age(response):
     if response.cache_control.s_maxage is not None:
-        return response.cache_control.s_maxage
+        # werkzeug doesn't type s-maxage like it does max-age
+        try:
+            return int(response.cache_control.s_maxage)
+        except ValueError:
+            return 0
     if response.cache_control.max_age is not None:
         return response.cache_control.max_age
     return None
@@ -16,9 +22,22 @@ def none_or_truthy(v):
         return True
     return bool(v)
 
-def werkzeug_cache_get_or_add(cache, key, new_obj, expiry_seconds):
-    stored_obj = None
-    while stored_obj is None:
+def werkzeug_cache_get_or_add(cache, key, new_obj, expiry_seconds,
+                              attempts=3):
+    for attempt in range(attempts):
         cache.add(key, new_obj, expiry_seconds)
         stored_obj = cache.get(key)
-    return stored_obj
+        if stored_obj is not None:
+            return stored_obj
+    # the cache isn't storing (it may be full, failing or bypassed)
+    return new_obj
+
+def copy_response(response):
+    "Shallow copy of a response, safe for header modification"
+    rv = copy(response)
+    rv.headers = response.headers.copy()
+    return rv
+
+def utc_timestamp(dt):
+    "Seconds since the epoch of a naive UTC datetime (like werkzeug's dates)"
+    return timegm(dt.utctimetuple())
@@ -0,0 +1,574 @@
+from __future__ import unicode_literals
+from threading import Event, Thread
+from time import time
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from flask import Flask
+from werkzeug.wrappers import Response
+from flask_webcache import backends
+from flask_webcache import easy_setup
+from flask_webcache.backends import (MemoryCache, SharedMemoryCache, ShardedCache, CircuitBreakerCache,
+                                    WriteBehindCache, shared_memory_path)
+from flask_webcache.storage import Config, Store, Retrieval
+from flask_webcache.utils import werkzeug_cache_get_or_add
+
+a = Flask(__name__)
+
+class MemoryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = MemoryCache()
+
+    def test_basic_operations(self):
+        self.assertIsNone(self.c.get('foo'))
+        self.assertTrue(self.c.set('foo', 'bar'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertTrue(self.c.has('foo'))
+        self.assertFalse(self.c.add('foo', 'qux'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertTrue(self.c.delete('foo'))
+        self.assertFalse(self.c.delete('foo'))
+        self.assertTrue(self.c.add('foo', 'qux'))
+        self.assertEquals(self.c.get('foo'), 'qux')
+        self.c.clear()
+        self.assertEquals(len(self.c), 0)
+        self.assertEquals(self.c.total_bytes, 0)
+
+    def test_inc_dec(self):
+        self.assertEquals(self.c.inc('foo'), 1)
+        self.assertEquals(self.c.inc('foo', 5), 6)
+        self.assertEquals(self.c.dec('foo'), 5)
+
+    def test_expiry(self):
+        self.c.set('foo', 'bar', -1)
+        self.assertIsNone(self.c.get('foo'))
+        self.assertTrue(self.c.add('foo', 'qux', 10))
+        self.assertEquals(self.c.get('foo'), 'qux')
+        self.c.set('bar', 'baz', 0)
+        self.assertEquals(self.c.get('bar'), 'baz')
+
+    def test_expiry_purges_in_bulk(self):
+        for i in range(10):
+            self.c.set('foo%d' % i, 'bar', 5 if i % 2 else 50)
+        self.assertEquals(len(self.c), 10)
+        now = time()
+        backends.time = lambda: now + 10
+        try:
+            self.c.set('bar', 'baz')
+        finally:
+            backends.time = time
+        self.assertEquals(len(self.c), 6)
+        self.assertFalse(self.c.has('foo3'))
+        self.assertTrue(self.c.has('foo4'))
+
+    def test_lru_threshold(self):
+        c = MemoryCache(threshold=2)
+        c.set('foo', 1)
+        c.set('bar', 2)
+        c.get('foo')
+        c.set('baz', 3)
+        self.assertEquals(c.get('foo'), 1)
+        self.assertIsNone(c.get('bar'))
+        self.assertEquals(c.get('baz'), 3)
+
+    def test_byte_budget(self):
+        c = MemoryCache(max_bytes=1000)
+        body = 'x' * 400
+        c.set('foo', Response(body))
+        c.set('bar', Response(body))
+        self.assertEquals(len(c), 2)
+        c.set('baz', Response(body))
+        self.assertEquals(len(c), 2)
+        self.assertIsNone(c.get('foo'))
+        self.assertLessEqual(c.total_bytes, 1000)
+        self.assertFalse(c.set('qux', Response('x' * 2000)))
+        self.assertIsNone(c.get('qux'))
+
+    def test_responses_are_not_shared(self):
+        r = Response('foo')
+        r.freeze()
+        self.c.set('foo', r)
+        r.headers['X-Foo'] = 'bar'
+        cached = self.c.get('foo')
+        self.assertNotIn('x-foo', cached.headers)
+        cached.headers['X-Bar'] = 'qux'
+        self.assertNotIn('x-bar', self.c.get('foo').headers)
+        self.assertEquals(cached.data, b'foo')
+
+    def test_concurrent_add(self):
+        results = []
+        def adder(i):
+            results.append(werkzeug_cache_get_or_add(self.c, 'foo', i, 10))
+        threads = [Thread(target=adder, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(results)), 1)
+
+    def test_store_retrieve_cycle(self):
+        s, r = Store(self.c), Retrieval(self.c)
+        with a.test_request_context('/foo'):
+            response = Response('foo')
+            s.cache_response(response)
+            s.mark_cache_miss(response)
+            cached = r.fetch_response()
+            self.assertEquals(cached.data, b'foo')
+            self.assertEquals(cached.headers[s.X_CACHE_HEADER], 'hit')
+
+    def test_stored_metadata_doesnt_pin_responses(self):
+        s = Store(self.c)
+        refs = []
+        for i in range(20):
+            with a.test_request_context('/foo%d' % i):
+                response = Response('foo')
+                response.vary.add('Accept-Encoding')
+                s.cache_response(response)
+                refs.append(weakref.ref(response))
+        del response
+        gc.collect()
+        self.assertEquals([ref for ref in refs if ref() is not None], [])
+        with a.test_request_context('/foo0'):
+            metadata = self.c.get(s.metadata_cache_key())
+            self.assertEquals(metadata.vary.to_header(), 'Accept-Encoding')
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'shared memory cache requires POSIX')
+class SharedMemoryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+        self.c = SharedMemoryCache(self.path, slots=16, slot_size=1024)
+
+    def tearDown(self):
+        self.c.close()
+        shutil.rmtree(self.directory)
+
+    def test_basic_operations(self):
+        self.assertIsNone(self.c.get('foo'))
+        self.assertTrue(self.c.set('foo', 'bar'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertTrue(self.c.has('foo'))
+        self.assertFalse(self.c.add('foo', 'qux'))
+        self.assertTrue(self.c.delete('foo'))
+        self.assertFalse(self.c.delete('foo'))
+        self.assertTrue(self.c.add('foo', 'qux'))
+        self.assertEquals(self.c.get('foo'), 'qux')
+        self.assertEquals(self.c.inc('bar', 2), 2)
+        self.assertEquals(self.c.dec('bar'), 1)
+        self.c.clear()
+        self.assertIsNone(self.c.get('foo'))
+
+    def test_expiry(self):
+        self.c.set('foo', 'bar', -1)
+        self.assertIsNone(self.c.get('foo'))
+        self.assertFalse(self.c.has('foo'))
+        self.assertTrue(self.c.add('foo', 'qux'))
+        self.assertEquals(self.c.get('foo'), 'qux')
+
+    def test_oversized_values(self):
+        self.assertFalse(self.c.set('foo', 'x' * 2048))
+        self.assertIsNone(self.c.get('foo'))
+
+    def test_eviction(self):
+        for i in range(64):
+            self.assertTrue(self.c.set('foo%d' % i, i, 100 + i))
+        self.assertEquals(self.c.get('foo63'), 63)
+        stored = [i for i in range(64) if self.c.get('foo%d' % i) is not None]
+        self.assertLessEqual(len(stored), 16)
+
+    def test_torn_slots(self):
+        # as left by a process killed while writing, which pickle can't load
+        for garbage in (b'\x80\x02}q', b'\x80\x02cnope\nNope\nq\x00.', b'x' * 8):
+            self.c.set('foo', 'bar' * 10)
+            index, expires, start, vlen = self.c._find(b'foo', self.c._hash(b'foo'))
+            self.c._map[start:start + len(garbage)] = garbage
+            self.assertIsNone(self.c.get('foo'))
+            self.assertIsNone(self.c._find(b'foo', self.c._hash(b'foo'))) # discarded
+        self.c.set('foo', 'bar')
+        self.assertEquals(self.c.get('foo'), 'bar')
+
+    def test_shared_between_instances(self):
+        other = SharedMemoryCache(self.path, slots=16, slot_size=1024)
+        try:
+            self.c.set('foo', 'bar')
+            self.assertEquals(other.get('foo'), 'bar')
+        finally:
+            other.close()
+
+    def test_geometry_mismatch(self):
+        self.c.set('foo', 'bar')
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, slots=32, slot_size=1024)
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, slots=16, slot_size=512)
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertTrue(self.c.set('qux', 'x' * 512))
+
+    def test_path(self):
+        self.assertTrue(shared_memory_path('myapp').endswith('flask-webcache-myapp'))
+        self.assertRaises(TypeError, SharedMemoryCache)
+
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.c.set('foo', Response('bar'))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEquals(self.c.get('foo').data, b'bar')
+
+    def test_store_retrieve_cycle(self):
+        s, r = Store(self.c), Retrieval(self.c)
+        with a.test_request_context('/foo'):
+            s.cache_response(Response('foo'))
+            self.assertEquals(r.fetch_response().data, b'foo')
+
+class ShardedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = dict(('node%d' % i, MemoryCache()) for i in range(4))
+        self.c = ShardedCache(self.nodes)
+
+    def test_basic_operations(self):
+        self.assertTrue(self.c.set('foo', 'bar'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertFalse(self.c.add('foo', 'qux'))
+        self.assertTrue(self.c.has('foo'))
+        self.assertEquals(self.c.inc('count'), 1)
+        self.assertTrue(self.c.set_many(dict(('key%d' % i, i) for i in range(20))))
+        self.assertEquals(self.c.get_many('key3', 'foo', 'key17', 'nope'),
+                          [3, 'bar', 17, None])
+        self.assertTrue(self.c.delete_many('key3', 'key17'))
+        self.assertEquals(self.c.get_many('key3', 'key4'), [None, 4])
+        self.assertTrue(self.c.delete('foo'))
+        self.c.clear()
+        self.assertEquals(sum(len(node) for node in self.nodes.values()), 0)
+
+    def test_resource_colocation(self):
+        self.assertEquals(self.c.resource_of('metadata:/foo?a=b:c'), '/foo?a=b:c')
+        self.assertEquals(self.c.resource_of('representation:abc:/foo:bar'), '/foo:bar')
+        self.assertEquals(self.c.resource_of('recache:abc:/foo'), '/foo')
+        self.assertEquals(self.c.resource_of('other:key'), 'other:key')
+        for i in range(50):
+            path = '/resource/%d' % i
+            names = set(self.c.node_name_for(key) for key in (
+                'metadata:' + path, 'representation:abc:' + path,
+                'representation:def:' + path, 'recache:abc:' + path))
+            self.assertEquals(len(names), 1)
+
+    def test_minimal_movement(self):
+        keys = ['metadata:/resource/%d' % i for i in range(2000)]
+        before = dict((key, self.c.node_name_for(key)) for key in keys)
+        self.c.add_node('node4', MemoryCache())
+        moved = [key for key in keys if self.c.node_name_for(key) != before[key]]
+        self.assertTrue(all(self.c.node_name_for(key) == 'node4' for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.35)
+        self.c.remove_node('node4')
+        self.assertEquals(before, dict((key, self.c.node_name_for(key)) for key in keys))
+
+    def test_spread(self):
+        names = [self.c.node_name_for('metadata:/resource/%d' % i) for i in range(2000)]
+        for name in self.nodes:
+            self.assertGreater(names.count(name), 2000 / 4 / 2)
+
+    def test_store_retrieve_cycle(self):
+        s, r = Store(self.c), Retrieval(self.c)
+        with a.test_request_context('/foo'):
+            s.cache_response(Response('foo'))
+            self.assertEquals(r.fetch_response().data, b'foo')
+            node = self.c.node_for(s.metadata_cache_key())
+            self.assertEquals(len(node), 2)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class DelayedCache(MemoryCache):
+    "MemoryCache with injectable delays (on a fake clock) and failures"
+    def __init__(self, clock):
+        super(DelayedCache, self).__init__()
+        self.clock = clock
+        self.delay = 0
+        self.failing = False
+        self.calls = 0
+    def tick(self):
+        self.calls += 1
+        self.clock.now += self.delay
+        if self.failing:
+            raise IOError('backend down')
+    def get(self, key):
+        self.tick()
+        return super(DelayedCache, self).get(key)
+    def set(self, key, value, timeout=None):
+        self.tick()
+        return super(DelayedCache, self).set(key, value, timeout)
+    def add(self, key, value, timeout=None):
+        self.tick()
+        return super(DelayedCache, self).add(key, value, timeout)
+    def delete(self, key):
+        self.tick()
+        return super(DelayedCache, self).delete(key)
+    def delete_many(self, *keys):
+        self.tick()
+        return super(DelayedCache, self).delete_many(*keys)
+    def clear(self):
+        self.tick()
+        return super(DelayedCache, self).clear()
+
+class CircuitBreakerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = DelayedCache(self.clock)
+        self.c = CircuitBreakerCache(self.backend, timeout=0.05, request_budget=None,
+                                     failure_threshold=3, reset_seconds=30,
+                                     clock=self.clock)
+
+    def test_passthrough(self):
+        self.assertTrue(self.c.set('foo', 'bar'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertEquals(self.c.state, self.c.CLOSED)
+
+    def test_failures_open_breaker(self):
+        self.c.set('foo', 'bar')
+        self.backend.failing = True
+        for i in range(3):
+            self.assertIsNone(self.c.get('foo'))
+        self.assertEquals(self.c.state, self.c.OPEN)
+        self.backend.failing = False
+        calls = self.backend.calls
+        self.assertIsNone(self.c.get('foo'))
+        self.assertFalse(self.c.set('foo', 'qux'))
+        self.assertEquals(self.backend.calls, calls)
+        self.assertEquals(self.c.status()['bypassed'], 2)
+
+    def test_slow_calls_open_breaker(self):
+        self.c.set('foo', 'bar')
+        self.backend.delay = 0.1
+        for i in range(3):
+            self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertEquals(self.c.state, self.c.OPEN)
+        self.assertIsNone(self.c.get('foo'))
+
+    def test_intermittent_failures_dont_open_breaker(self):
+        self.c.set('foo', 'bar')
+        for i in range(5):
+            self.backend.failing = True
+            self.c.get('foo')
+            self.backend.failing = False
+            self.c.get('foo')
+        self.assertEquals(self.c.state, self.c.CLOSED)
+
+    def test_half_open_probe(self):
+        self.c.set('foo', 'bar')
+        self.backend.failing = True
+        for i in range(3):
+            self.c.get('foo')
+        self.clock.now += 31
+        self.assertIsNone(self.c.get('foo')) # failed probe
+        self.assertEquals(self.c.state, self.c.OPEN)
+        self.backend.failing = False
+        self.clock.now += 31
+        self.assertEquals(self.c.get('foo'), 'bar') # successful probe
+        self.assertEquals(self.c.state, self.c.CLOSED)
+
+    def test_request_budget(self):
+        c = CircuitBreakerCache(self.backend, timeout=1, request_budget=0.1,
+                                clock=self.clock)
+        c.set('foo', 'bar')
+        self.backend.delay = 0.04
+        with a.test_request_context('/foo'):
+            self.assertEquals(c.get('foo'), 'bar')
+            self.assertEquals(c.get('foo'), 'bar')
+            self.assertEquals(c.get('foo'), 'bar')
+            self.assertIsNone(c.get('foo'))
+        with a.test_request_context('/foo'):
+            self.assertEquals(c.get('foo'), 'bar')
+        self.assertEquals(c.state, c.CLOSED)
+
+    def test_registration(self):
+        app = Flask(__name__)
+        c = CircuitBreakerCache(self.backend, app)
+        self.assertIs(app.extensions['webcache']['breaker'], c)
+        self.assertEquals(c.status()['state'], c.CLOSED)
+
+    def test_full_cycle_with_open_breaker(self):
+        app = Flask(__name__)
+        easy_setup(app, self.c)
+        @app.route('/foo')
+        def foo():
+            return 'bar'
+        self.backend.failing = True
+        for i in range(5):
+            response = app.test_client().get('/foo')
+            self.assertEquals(response.data, b'bar')
+        self.assertEquals(self.c.state, self.c.OPEN)
+
+    def test_invalidation_with_open_breaker(self):
+        app = Flask(__name__)
+        easy_setup(app, self.c)
+        body = ['old']
+        @app.route('/foo', methods=('GET', 'PUT'))
+        def foo():
+            return body[0]
+        client = app.test_client()
+        client.get('/foo')
+        self.assertEquals(client.get('/foo').headers['x-cache'], 'hit')
+        self.backend.delay = 0.1
+        for i in range(3):
+            client.get('/foo')
+        self.assertEquals(self.c.state, self.c.OPEN)
+        self.backend.delay = 0
+        body[0] = 'new'
+        client.put('/foo')
+        self.clock.now += 31
+        self.assertEquals(client.get('/foo').data, b'new')
+
+    def test_failed_deletes_are_retried(self):
+        self.c.set('foo', 'bar')
+        self.c.set('qux', 'bar')
+        self.backend.failing = True
+        self.c.delete('foo')
+        self.assertEquals(self.c.status()['pending_deletes'], 1)
+        self.backend.failing = False
+        self.assertIsNone(self.c.get('foo')) # pending, so a miss
+        self.assertEquals(self.c.get('qux'), 'bar') # retried after a call
+        self.assertIsNone(self.backend.get('foo'))
+        self.assertEquals(self.c.status()['pending_deletes'], 0)
+        self.assertEquals(self.c.get_many('foo', 'qux'), [None, 'bar'])
+
+    def test_dropped_invalidations(self):
+        c = CircuitBreakerCache(self.backend, clock=self.clock, max_pending_deletes=2)
+        self.backend.failing = True
+        c.delete_many('foo', 'bar', 'baz')
+        c.clear()
+        self.assertEquals(c.status()['pending_deletes'], 2)
+        self.assertEquals(c.status()['dropped_invalidations'], 2)
+        self.assertFalse(c.has('baz') or c.has('bar'))
+        self.assertEquals(c.state, c.CLOSED) # invalidations don't open it
+
+class BlockingCache(MemoryCache):
+    "MemoryCache whose set() blocks until released"
+    def __init__(self):
+        super(BlockingCache, self).__init__()
+        self.release = Event()
+        self.setting = Event()
+    def set(self, key, value, timeout=None):
+        self.setting.set()
+        self.release.wait(5)
+        return super(BlockingCache, self).set(key, value, timeout)
+
+class WriteBehindCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = BlockingCache()
+        self.c = WriteBehindCache(self.backend, max_pending=2)
+
+    def tearDown(self):
+        self.backend.release.set()
+        self.c.flush(5)
+
+    def block_writer(self):
+        self.c.set('blocker', 'blocker')
+        self.assertTrue(self.backend.setting.wait(5))
+
+    def test_write_behind(self):
+        self.block_writer()
+        self.c.set('foo', 'bar')
+        self.assertIsNone(self.backend.get('foo'))
+        self.assertEquals(self.c.get('foo'), 'bar')
+        self.assertTrue(self.c.has('foo'))
+        self.assertFalse(self.c.add('foo', 'qux'))
+        self.assertEquals(self.c.status()['depth'], 1)
+        self.backend.release.set()
+        self.assertTrue(self.c.flush(5))
+        self.assertEquals(self.backend.get('foo'), 'bar')
+        self.assertEquals(self.c.status()['written'], 2)
+
+    def test_coalescing_and_dropping(self):
+        self.block_writer()
+        self.assertTrue(self.c.set('foo', 1))
+        self.assertTrue(self.c.set('foo', 2))
+        self.assertTrue(self.c.set('bar', 1))
+        self.assertFalse(self.c.set('baz', 1))
+        status = self.c.status()
+        self.assertEquals((status['depth'], status['coalesced'], status['dropped']), (2, 1, 1))
+        self.backend.release.set()
+        self.c.flush(5)
+        self.assertEquals(self.backend.get('foo'), 2)
+        self.assertIsNone(self.backend.get('baz'))
+
+    def test_delete_cancels_pending_write(self):
+        self.block_writer()
+        self.c.set('foo', 'bar')
+        self.assertFalse(self.c.delete('foo'))
+        self.assertIsNone(self.c.get('foo'))
+        self.c.delete('blocker') # in flight
+        self.backend.release.set()
+        self.c.flush(5)
+        self.assertIsNone(self.backend.get('foo'))
+        self.assertIsNone(self.backend.get('blocker'))
+
+    def test_add_is_synchronous(self):
+        self.block_writer()
+        self.assertEquals(werkzeug_cache_get_or_add(self.c, 'foo', 'bar', 10), 'bar')
+        self.assertEquals(self.backend.get('foo'), 'bar')
+        self.assertEquals(werkzeug_cache_get_or_add(self.c, 'foo', 'qux', 10), 'bar')
+
+    def test_inc_only_waits_for_its_key(self):
+        self.block_writer()
+        self.assertEquals(self.c.inc('count'), 1) # doesn't wait for blocker
+        self.c.set('count', 5)
+        results = []
+        thread = Thread(target=lambda: results.append(self.c.inc('count')))
+        thread.start()
+        thread.join(0.1)
+        self.assertEquals(results, []) # waits for the pending write
+        self.backend.release.set()
+        thread.join(5)
+        self.assertEquals(results, [6])
+
+    def test_resource_index_stays_asynchronous(self):
+        c = WriteBehindCache(self.backend)
+        c.set('blocker', 'blocker')
+        self.assertTrue(self.backend.setting.wait(5))
+        s = Store(c, Config(resource_index=True))
+        def store(path):
+            with a.test_request_context(path):
+                s.cache_response(Response('foo'))
+        for path in ('/foo/bar', '/foo/baz', '/foo/bar'):
+            thread = Thread(target=store, args=(path,))
+            thread.start()
+            thread.join(1)
+            self.assertFalse(thread.is_alive()) # didn't wait for the writer
+        self.assertEquals(sorted(s.indexed_resources()), ['/foo/bar', '/foo/baz'])
+        self.backend.release.set()
+        self.assertTrue(c.flush(5))
+
+    def test_responses_are_snapshotted(self):
+        self.block_writer()
+        r = Response('foo')
+        r.freeze()
+        self.c.set('foo', r)
+        r.headers['X-Cache'] = 'miss'
+        self.assertNotIn('x-cache', self.c.get('foo').headers)
+
+    def test_full_cycle(self):
+        self.backend.release.set()
+        app = Flask(__name__)
+        c = WriteBehindCache(self.backend, app)
+        self.assertIs(app.extensions['webcache']['writer'], c)
+        easy_setup(app, c)
+        @app.route('/foo')
+        def foo():
+            return 'bar'
+        self.assertEquals(app.test_client().get('/foo').headers['x-cache'], 'miss')
+        c.flush(5)
+        self.assertEquals(app.test_client().get('/foo').headers['x-cache'], 'hit')
@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+import unittest
+
+from flask import Flask
+from flask_webcache.backends import MemoryCache
+from flask_webcache.handlers import RequestHandler, ResponseHandler
+from flask_webcache.storage import Config
+
+class CLITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = MemoryCache()
+        cfg = Config(resource_index=True)
+        RequestHandler(self.cache, self.app, cfg)
+        self.handler = ResponseHandler(self.cache, self.app, cfg)
+        @self.app.route('/foo/<name>')
+        def foo(name):
+            return name
+        @self.app.route('/bar')
+        def bar():
+            return 'bar'
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+
+    def invoke(self, *args):
+        result = self.runner.invoke(args=('webcache',) + args)
+        self.assertEquals(result.exit_code, 0, result.output)
+        return result.output
+
+    def warm(self):
+        self.invoke('warm', '/foo/a', '/foo/b', '/bar', '/bar?x=1')
+
+    def test_warm_and_list(self):
+        output = self.invoke('warm', '/foo/a', '/foo/b', '/bar')
+        self.assertIn('/foo/a\t200\tmiss', output)
+        self.assertIn('/foo/a\t200\thit', self.invoke('warm', '/foo/a'))
+        self.assertIn('/foo/a\t200\tmiss', self.invoke('warm', '--refresh', '/foo/a'))
+        lines = self.invoke('list').splitlines()
+        self.assertEquals([line.split('\t')[0] for line in lines], ['/bar', '/foo/a', '/foo/b'])
+        self.assertEquals(len(self.invoke('list', '/foo/').splitlines()), 2)
+        self.assertEquals(len(self.invoke('list', '/fo').splitlines()), 2)
+        self.assertEquals(len(self.invoke('list', '--pattern', '*/b').splitlines()), 1)
+
+    def test_warm_from_file(self):
+        result = self.runner.invoke(args=('webcache', 'warm', '--from-file', '-'),
+                                    input='/foo/a\n\n/bar\n')
+        self.assertEquals(result.output.count('miss'), 2)
+
+    def test_stats(self):
+        self.warm()
+        output = self.invoke('stats')
+        self.assertIn('backend: MemoryCache', output)
+        self.assertIn('resources: 3', output) # query strings aren't cached by default
+        self.assertIn('bytes: 5', output)
+
+    def test_show(self):
+        self.warm()
+        output = self.invoke('show', '/foo/a')
+        self.assertIn('resource: /foo/a', output)
+        self.assertIn('size: 1 bytes', output)
+        result = self.runner.invoke(args=('webcache', 'show', '/nope'))
+        self.assertNotEquals(result.exit_code, 0)
+
+    def test_purge(self):
+        self.warm()
+        self.assertEquals(self.invoke('purge', '/foo/').splitlines(),
+                          ['purged /foo/a', 'purged /foo/b'])
+        self.assertEquals(self.client.get('/foo/a').headers['x-cache'], 'miss')
+        self.assertEquals(self.client.get('/bar').headers['x-cache'], 'hit')
+        result = self.runner.invoke(args=('webcache', 'purge'))
+        self.assertNotEquals(result.exit_code, 0)
+        self.invoke('purge', '/')
+        self.assertEquals(self.invoke('list'), '')
+
+    def test_evict(self):
+        self.warm()
+        self.assertIn('evicted /bar', self.invoke('evict', '/bar'))
+        self.assertEquals(self.client.get('/bar').headers['x-cache'], 'miss')
+        self.assertEquals(self.client.get('/foo/a').headers['x-cache'], 'hit')
+
+    def test_index_disabled(self):
+        app = Flask(__name__)
+        ResponseHandler(MemoryCache(), app)
+        result = app.test_cli_runner().invoke(args=('webcache', 'list'))
+        self.assertNotEquals(result.exit_code, 0)
+        self.assertIn('resource index is disabled', result.output)
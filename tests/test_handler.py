@@ -2,8 +2,11 @@ from __future__ import unicode_literals
 import unittest
 from six.moves.http_client import NOT_MODIFIED
 
-from flask import Flask
+from flask import Flask, g
 from flask_webcache import easy_setup
+from flask_webcache.backends import MemoryCache
+from flask_webcache.handlers import RequestHandler, ResponseHandler
+from flask_webcache.storage import Config
 
 class HandlerTestCase(unittest.TestCase):
 
@@ -28,3 +31,93 @@ class HandlerTestCase(unittest.TestCase):
         self.assertIn('etag', first.headers)
         second = self.a.test_client().get('/foo', headers=(("if-none-match", first.headers['etag']),))
         self.assertEquals(second.status_code, NOT_MODIFIED)
+
+    def test_age_header(self):
+        first = self.a.test_client().get('/foo')
+        self.assertNotIn('age', first.headers)
+        second = self.a.test_client().get('/foo')
+        self.assertEquals(second.headers['age'], '0')
+        self.assertEquals(second.headers['date'], first.headers['date'])
+
+    def test_cached_response_skips_processing(self):
+        self.a.test_client().get('/foo')
+        handler = self.a.extensions['webcache']['response']
+        def fail(response):
+            self.fail('unexpected response processing of cached response')
+        handler.add_date_fields = handler.set_etag = fail
+        second = self.a.test_client().get('/foo')
+        self.assertEquals(second.headers['x-cache'], 'hit')
+        self.assertEquals(second.data, b'bar')
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Flask(__name__)
+        self.traces = []
+        cfg = Config(trace_headers=True, trace_callback=self.traces.append,
+                     resource_exemptions=('/static/',))
+        cache = MemoryCache()
+        RequestHandler(cache, self.a, cfg)
+        ResponseHandler(cache, self.a, cfg)
+        @self.a.route('/foo')
+        @self.a.route('/static/foo')
+        def foo():
+            return 'bar'
+        self.client = self.a.test_client()
+
+    def stage_names(self, response):
+        return [metric.split(';')[0] for metric in
+                response.headers['server-timing'].split(', ')]
+
+    def test_miss_and_hit(self):
+        first = self.client.get('/foo')
+        self.assertEquals(first.headers['x-cache'], 'miss; reason=NoResourceMetadata')
+        self.assertEquals(self.stage_names(first),
+                          ['webcache-metadata', 'webcache-etag', 'webcache-store'])
+        second = self.client.get('/foo')
+        self.assertEquals(second.headers['x-cache'], 'hit')
+        self.assertEquals(self.stage_names(second), ['webcache-metadata',
+                          'webcache-representation', 'webcache-freshness'])
+        self.assertEquals(second.data, b'bar')
+        self.assertEquals(self.client.get('/foo').headers['x-cache'], 'hit')
+
+    def test_reasons(self):
+        self.client.get('/foo')
+        nocache = self.client.get('/foo', headers={'Cache-Control': 'no-cache'})
+        self.assertEquals(nocache.headers['x-cache'], 'miss; reason=bypass')
+        exempt = self.client.get('/static/foo')
+        self.assertEquals(exempt.headers['x-cache'], 'uncached; reason=exempt')
+        self.assertEquals(self.stage_names(exempt), ['webcache-etag'])
+        picky = self.client.get('/foo', headers={'Cache-Control': 'min-fresh=1000'})
+        self.assertEquals(picky.headers['x-cache'],
+                          'miss; reason=NotFreshEnoughForClient')
+
+    def test_callback(self):
+        self.client.get('/foo')
+        self.client.get('/foo')
+        self.assertEquals([(t.resource, t.outcome, t.reason) for t in self.traces],
+                          [('/foo', 'miss', 'NoResourceMetadata'), ('/foo', 'hit', None)])
+        for name, seconds in self.traces[1].stages:
+            self.assertTrue(0 <= seconds < 1)
+
+    def test_callback_only(self):
+        cfg = self.a.extensions['webcache']['response'].config
+        cfg.trace_headers = False
+        response = self.client.get('/foo')
+        self.assertEquals(response.headers['x-cache'], 'miss')
+        self.assertNotIn('server-timing', response.headers)
+        self.assertEquals(len(self.traces), 1)
+
+    def test_disabled(self):
+        app = Flask(__name__)
+        easy_setup(app)
+        @app.route('/foo')
+        def foo():
+            return 'bar'
+        with app.test_client() as client:
+            for i in range(2):
+                response = client.get('/foo')
+                self.assertIsNone(g.webcache_trace)
+                self.assertNotIn('server-timing', response.headers)
+        self.assertEquals(response.headers['x-cache'], 'hit')
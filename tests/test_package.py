@@ -0,0 +1,40 @@
+from __future__ import unicode_literals
+import os
+import subprocess
+import sys
+import unittest
+
+import flask_webcache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class PackageTestCase(unittest.TestCase):
+
+    def run_python(self, program):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        output = subprocess.check_output([sys.executable, '-c', program], cwd=ROOT, env=env)
+        return output.decode('utf-8').split()
+
+    def test_import_is_lazy(self):
+        program = ('import sys, flask_webcache\n'
+                   'print(" ".join(sorted(m for m in sys.modules if m == "flask" or '
+                   'm.startswith("flask_webcache."))) or "-")')
+        self.assertEquals(self.run_python(program), ['-'])
+
+    def test_submodules_are_imported_on_access(self):
+        program = ('import sys, flask_webcache\n'
+                   'flask_webcache.storage\n'
+                   'print("flask_webcache.storage" in sys.modules, "flask" in sys.modules)')
+        self.assertEquals(self.run_python(program), ['True', 'True'])
+
+    def test_attributes(self):
+        from flask_webcache import modifiers
+        from flask_webcache.storage import Config
+        self.assertIs(flask_webcache.modifiers, modifiers)
+        self.assertIs(flask_webcache.storage.Config, Config)
+        self.assertTrue(callable(flask_webcache.easy_setup))
+        for name in flask_webcache.SUBMODULES + ('easy_setup',):
+            self.assertIn(name, dir(flask_webcache))
+        self.assertRaises(AttributeError, getattr, flask_webcache, 'nope')
+        self.assertFalse(hasattr(flask_webcache, 'nope'))
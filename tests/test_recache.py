@@ -0,0 +1,116 @@
+from __future__ import unicode_literals
+from time import time
+import unittest
+
+from flask import Flask
+from werkzeug.datastructures import HeaderSet
+from flask_webcache.handlers import RequestHandler, ResponseHandler
+from flask_webcache.modifiers import cache_for
+from flask_webcache.recache import RecacheScheduler, RECACHE_HEADER
+from flask_webcache.storage import Config
+from flask_webcache.backends import MemoryCache
+
+a = Flask(__name__)
+
+class RecacheSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.now = time()
+
+    def mkscheduler(self, **kwargs):
+        kwargs.setdefault('min_hits', 2)
+        return RecacheScheduler(dispatch=self.dispatched.append, **kwargs)
+
+    def hit(self, scheduler, path, times=1, freshness=60, salt='salt'):
+        with a.test_request_context(path):
+            if path not in scheduler.resources:
+                scheduler.record_render(path, salt, None, freshness, now=self.now)
+            for i in range(times):
+                scheduler.record_hit(path, freshness, now=self.now)
+
+    def test_dispatch_before_expiry(self):
+        s = self.mkscheduler(lead_seconds=10)
+        self.hit(s, '/foo', times=5)
+        self.assertEquals(s.tick(self.now + 40), 0)
+        self.assertEquals(s.tick(self.now + 55), 1)
+        app_factory, method, path, query_string, headers = self.dispatched[0]
+        self.assertEquals((method, path), ('GET', '/foo'))
+        self.assertEquals(headers[RECACHE_HEADER], 'salt')
+        self.assertEquals(s.tick(self.now + 56), 0) # dispatched once per expiry
+
+    def test_hits_are_queued(self):
+        s = self.mkscheduler(lead_seconds=10)
+        s.record_hit('/nope', 60, now=self.now) # never rendered, so untracked
+        self.hit(s, '/foo', times=5)
+        self.assertEquals(s.resources['/foo'].popularity, 0)
+        self.assertEquals(len(s.hits), 6)
+        self.assertEquals(s.tick(self.now + 55), 1)
+        self.assertEquals(len(s.hits), 0)
+        self.assertNotIn('/nope', s.resources)
+
+    def test_dispatch_args_only_keep_selecting_headers(self):
+        s = self.mkscheduler()
+        headers = {'Cookie': 'session=secret', 'Authorization': 'Basic Zm9v',
+                   'Accept-Language': 'fr', 'Host': 'example.com'}
+        with a.test_request_context('/foo', headers=headers):
+            s.record_render('/foo', 'salt', 0.1, 60, vary=HeaderSet(['Accept-Language']))
+        headers = s.resources['/foo'].args[4]
+        self.assertEquals(sorted(headers.keys()), ['Accept-Language', 'Host', RECACHE_HEADER])
+        self.assertEquals(headers['Accept-Language'], 'fr')
+
+    def test_unpopular_resources_lapse(self):
+        s = self.mkscheduler(lead_seconds=10)
+        self.hit(s, '/foo', times=1)
+        self.assertEquals(s.tick(self.now + 55), 0)
+        self.assertEquals(s.tick(self.now + 61), 0)
+        self.assertNotIn('/foo', s.resources)
+
+    def test_render_budget(self):
+        s = self.mkscheduler(lead_seconds=10, renders_per_second=1)
+        for path in ('/foo', '/bar', '/baz'):
+            self.hit(s, path, times=5)
+        self.assertEquals(s.tick(self.now + 51), 1)
+        self.assertEquals(s.tick(self.now + 51.5), 0)
+        self.assertEquals(s.tick(self.now + 52.5), 1)
+        self.assertEquals(s.tick(self.now + 53.5), 1)
+        self.assertEquals(len(set(args[2] for args in self.dispatched)), 3)
+
+    def test_top_resources_first(self):
+        s = self.mkscheduler(lead_seconds=10, top=1, renders_per_second=10)
+        self.hit(s, '/foo', times=3)
+        self.hit(s, '/bar', times=3)
+        with a.test_request_context('/bar'):
+            s.record_render('/bar', 'salt', 2.0, 60, now=self.now)
+        self.assertEquals(s.tick(self.now + 55), 1)
+        self.assertEquals(self.dispatched[0][2], '/bar')
+
+    def test_render_resets_dispatch(self):
+        s = self.mkscheduler(lead_seconds=10)
+        self.hit(s, '/foo', times=5)
+        self.assertEquals(s.tick(self.now + 55), 1)
+        with a.test_request_context('/foo'):
+            s.record_render('/foo', 'salt', 0.1, 60, now=self.now + 55)
+        self.assertEquals(s.tick(self.now + 106), 1)
+
+    def test_full_cycle(self):
+        app = Flask(__name__)
+        scheduler = RecacheScheduler(lead_seconds=10, min_hits=1)
+        c = MemoryCache()
+        cfg = Config(recache_scheduler=scheduler)
+        RequestHandler(c, app, cfg)
+        ResponseHandler(c, app, cfg)
+        renders = []
+        @app.route('/foo')
+        @cache_for(seconds=60)
+        def foo():
+            renders.append(1)
+            return 'bar'
+        client = app.test_client()
+        for i in range(3):
+            client.get('/foo')
+        self.assertEquals(len(renders), 1)
+        self.assertEquals(scheduler.tick(time() + 55), 1)
+        self.assertEquals(len(renders), 2)
+        self.assertEquals(client.get('/foo').headers['x-cache'], 'hit')
+        self.assertEquals(len(renders), 2)
@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+from collections import Counter
+from datetime import datetime
+from time import time
+import json
+import unittest
+
+from flask import Flask
+from flask_webcache import storage
+from flask_webcache.modifiers import cache_for
+from flask_webcache.simulation import (SimulatedClock, replay, compare, with_handlers, zipf_workload,
+                                       read_log, format_reports)
+from flask_webcache.storage import Config
+
+from testutils import compare_numbers
+
+def make_app():
+    app = Flask(__name__)
+    @app.route('/item/<int:n>')
+    @cache_for(seconds=10)
+    def item(n):
+        return 'x' * n
+    @app.route('/missing')
+    def missing():
+        return 'missing', 404
+    return app
+
+def request(t, path, **kwargs):
+    return dict(time=t, path=path, **kwargs)
+
+class SimulationTestCase(unittest.TestCase):
+
+    def test_simulated_clock(self):
+        with SimulatedClock(1000) as clock:
+            self.assertTrue(compare_numbers(1000, storage.time(), 1))
+            self.assertEquals(storage.datetime.utcnow().year, 1970)
+            clock.set(2000)
+            self.assertTrue(compare_numbers(2000, storage.time(), 1))
+        self.assertTrue(compare_numbers(time(), storage.time(), 1))
+        self.assertEquals(storage.datetime.utcnow().year, datetime.utcnow().year)
+
+    def test_replay_expiry(self):
+        start = 1388000000
+        log = [request(start, '/item/3'), request(start + 5, '/item/3'),
+               request(start + 9, '/item/3', query='a=1'),
+               request(start + 20, '/item/3'), request(start + 21, '/item/3')]
+        report = replay(with_handlers(make_app), log)
+        self.assertEquals(report.requests, 5)
+        self.assertEquals(report.hits, 2)
+        self.assertEquals(report.renders, 3)
+        self.assertEquals(report.hit_ratio, 2 / 5.0)
+        self.assertEquals(report.byte_hit_ratio, 6 / 15.0)
+        self.assertGreater(report.operations['get'], 0)
+        self.assertEquals(report.backend_operations, sum(report.operations.values()))
+
+    def test_compare_configs(self):
+        log = [request(1388000000 + i, '/missing') for i in range(10)]
+        reports = compare(with_handlers(make_app), log, {
+            'default': Config(),
+            'negative': Config(negative_caching=True),
+        })
+        self.assertEquals([r.name for r in reports], ['default', 'negative'])
+        self.assertEquals(reports[0].hits, 0)
+        self.assertEquals(reports[1].hits, 9)
+        table = format_reports(reports)
+        self.assertIn('hit ratio', table)
+        self.assertIn('90.0%', table)
+
+    def test_zipf_workload(self):
+        log = zipf_workload(requests=5000, resources=100, rate=10, path='/item/%d', seed=1)
+        self.assertEquals(len(log), 5000)
+        times = [entry['time'] for entry in log]
+        self.assertEquals(times, sorted(times))
+        self.assertTrue(compare_numbers(500, times[-1], 50))
+        counts = Counter(entry['path'] for entry in log)
+        self.assertGreater(counts['/item/1'], counts['/item/2'])
+        self.assertGreater(counts['/item/2'], counts['/item/10'])
+        self.assertTrue(compare_numbers(2, counts['/item/1'] / float(counts['/item/2']), 0.4))
+        self.assertEquals(zipf_workload(requests=10, seed=3), zipf_workload(requests=10, seed=3))
+
+    def test_read_log(self):
+        lines = [json.dumps(request(1, '/item/1', headers={'Accept': 'text/plain'})), '', '\n']
+        self.assertEquals(read_log(lines), [request(1, '/item/1', headers={'Accept': 'text/plain'})])
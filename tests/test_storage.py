@@ -1,17 +1,22 @@
 from __future__ import unicode_literals
 import unittest
 from datetime import timedelta, datetime
+from random import seed, random
+from time import time
 from six.moves.cPickle import dumps, loads
 from six import iteritems
 
-from flask import Flask, send_file
+from flask import Flask, send_file, g
 from werkzeug.wrappers import Response
 from werkzeug.datastructures import HeaderSet
 from werkzeug.contrib.cache import SimpleCache
+from flask_webcache import storage
 from flask_webcache.storage import Config, Metadata, Store, Retrieval
 from flask_webcache.storage import (CacheMiss, NoResourceMetadata, NoMatchingRepresentation, NotFreshEnoughForClient,
-                                    RecacheRequested)
+                                    RecacheRequested, StaleRepresentation)
+from flask_webcache.modifiers import revalidate_with, setup_for_this_request, after_request
 from flask_webcache.recache import RECACHE_HEADER
+from flask_webcache.simulation import CountingCache
 from flask_webcache.utils import werkzeug_cache_get_or_add
 
 from testutils import compare_numbers
@@ -71,6 +76,32 @@ class StorageTestCase(unittest.TestCase):
             self.assertFalse(check_response_with_cache_control(private=True))
             self.assertFalse(check_response_with_cache_control(no_cache=True))
             self.assertFalse(check_response_with_cache_control(no_store=True))
+            self.assertTrue(check_response_with_cache_control(private='Set-Cookie'))
+            self.assertTrue(check_response_with_cache_control(no_cache='Set-Cookie'))
+            self.assertFalse(check_response_with_cache_control(s_maxage=0, max_age=10))
+
+    def test_s_maxage_expiry(self):
+        r = Response()
+        r.cache_control.max_age = 10
+        self.assertEquals(self.s.response_expiry_seconds(r), 10)
+        r.cache_control.s_maxage = 20
+        self.assertEquals(self.s.response_expiry_seconds(r), 20)
+        r.date = datetime.utcnow()
+        self.assertTrue(compare_numbers(20, self.r.response_freshness_seconds(r), 1))
+
+    def test_field_specific_header_stripping(self):
+        with a.test_request_context('/foo'):
+            r = Response('foo', headers=(('Set-Cookie', 'session=secret'), ('X-Foo', 'bar')))
+            r.cache_control.private = 'Set-Cookie'
+            r.cache_control.no_cache = 'X-Foo'
+            self.assertTrue(self.s.should_cache_response(r))
+            self.s.cache_response(r)
+            self.assertEquals(r.headers['set-cookie'], 'session=secret')
+            self.assertEquals(r.headers['x-foo'], 'bar')
+            cached = self.r.fetch_response()
+            self.assertEquals(cached.data, b'foo')
+            self.assertNotIn('set-cookie', cached.headers)
+            self.assertNotIn('x-foo', cached.headers)
 
     def test_expire_cachability(self):
         def check_response_with_expires(dt):
@@ -87,6 +118,19 @@ class StorageTestCase(unittest.TestCase):
         with a.test_request_context('/foo', query_string='?bar'):
             self.assertFalse(self.s.should_cache_response(Response()))
 
+    def test_age_header(self):
+        with a.test_request_context('/foo'):
+            r = Response('foo')
+            r.date = datetime.utcnow() - timedelta(seconds=100)
+            self.s.cache_response(r)
+            cached = self.r.fetch_response()
+            self.r.add_age_header(cached)
+            self.assertTrue(compare_numbers(100, int(cached.headers['age']), 2))
+            self.assertNotIn('age', self.r.fetch_response().headers)
+        r = Response()
+        self.r.add_age_header(r)
+        self.assertNotIn('age', r.headers)
+
     def test_x_cache_headers(self):
         r = Response()
         self.s.mark_cache_hit(r)
@@ -228,6 +272,260 @@ class StorageTestCase(unittest.TestCase):
             r.make_sequence()
             self.assertFalse(self.s.should_cache_response(r))
 
+class NegativeCachingTestCase(unittest.TestCase):
+
+    def mkstore(self, **kwargs):
+        return Store(SimpleCache(), Config(**kwargs))
+
+    def test_default_status_cachability(self):
+        s = self.mkstore()
+        with a.test_request_context('/foo'):
+            self.assertFalse(s.should_cache_response(Response(status=404)))
+            self.assertFalse(s.should_cache_response(Response(status=410)))
+            self.assertFalse(s.should_cache_response(Response(status=301)))
+
+    def test_negative_caching(self):
+        s = self.mkstore(negative_caching=True)
+        with a.test_request_context('/foo'):
+            self.assertTrue(s.should_cache_response(Response(status=404)))
+            self.assertTrue(s.should_cache_response(Response(status=410)))
+            self.assertFalse(s.should_cache_response(Response(status=301)))
+            self.assertFalse(s.should_cache_response(Response(status=500)))
+            self.assertEquals(s.response_expiry_seconds(Response(status=404)),
+                              s.NEGATIVE_EXPIRATION_SECONDS[404])
+            r = Response(status=404)
+            r.cache_control.max_age = 5
+            self.assertEquals(s.response_expiry_seconds(r), 5)
+
+    def test_redirect_caching(self):
+        s = self.mkstore(redirect_caching=True)
+        with a.test_request_context('/foo'):
+            self.assertTrue(s.should_cache_response(Response(status=301)))
+            self.assertFalse(s.should_cache_response(Response(status=302)))
+            self.assertFalse(s.should_cache_response(Response(status=404)))
+            self.assertEquals(s.response_expiry_seconds(Response(status=301)),
+                              s.REDIRECT_EXPIRATION_SECONDS[301])
+
+    def test_per_status_policy(self):
+        s = self.mkstore(negative_caching=True,
+                         status_expiration_seconds={404: 0, 302: 10})
+        with a.test_request_context('/foo'):
+            self.assertFalse(s.should_cache_response(Response(status=404)))
+            self.assertTrue(s.should_cache_response(Response(status=410)))
+            self.assertTrue(s.should_cache_response(Response(status=302)))
+            self.assertEquals(s.response_expiry_seconds(Response(status=302)), 10)
+
+    def test_per_status_policy_success(self):
+        s = self.mkstore(status_expiration_seconds={200: 30, 203: 0})
+        with a.test_request_context('/foo'):
+            self.assertTrue(s.should_cache_response(Response(status=200)))
+            self.assertEquals(s.response_expiry_seconds(Response(status=200)), 30)
+            self.assertFalse(s.should_cache_response(Response(status=203)))
+            self.assertEquals(s.response_expiry_seconds(Response(status=206)),
+                              s.DEFAULT_EXPIRATION_SECONDS)
+
+    def test_negative_store_retrieve_cycle(self):
+        c = SimpleCache()
+        cfg = Config(negative_caching=True)
+        s, r = Store(c, cfg), Retrieval(c, cfg)
+        with a.test_request_context('/foo'):
+            s.cache_response(Response('nope', status=404))
+            cached = r.fetch_response()
+            self.assertEquals(cached.status_code, 404)
+            self.assertEquals(cached.data, b'nope')
+
+class FlakyCache(SimpleCache):
+    "SimpleCache whose inc() and add() fail while failing is set"
+    failing = False
+    def inc(self, key, delta=1):
+        return None if self.failing else SimpleCache.inc(self, key, delta)
+    def add(self, key, value, timeout=None):
+        return False if self.failing else SimpleCache.add(self, key, value, timeout)
+
+class ResourceIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = SimpleCache()
+        cfg = Config(resource_index=True)
+        self.s = Store(self.c, cfg)
+
+    def cache(self, path, body='foo'):
+        with a.test_request_context(path):
+            self.s.cache_response(Response(body))
+
+    def test_index_segments(self):
+        self.assertEquals(self.s.index_segment('/foo/bar?x'), 'foo')
+        self.assertEquals(self.s.index_segment('/foo?x/y'), 'foo')
+        self.assertEquals(self.s.index_segment('/'), '')
+
+    def test_indexing(self):
+        self.cache('/foo/bar', 'bar')
+        self.cache('/foo/baz')
+        self.cache('/food')
+        self.cache('/')
+        resources = self.s.indexed_resources()
+        self.assertEquals(sorted(resources), ['/', '/foo/bar', '/foo/baz', '/food'])
+        self.assertEquals(resources['/foo/bar']['size'], 3)
+        self.assertEquals(sorted(self.s.indexed_resources('/foo/')), ['/foo/bar', '/foo/baz'])
+        self.assertEquals(sorted(self.s.indexed_resources('/foo')), ['/foo/bar', '/foo/baz', '/food'])
+        self.assertEquals(sorted(self.s.indexed_resources(pattern='*ba?')), ['/foo/bar', '/foo/baz'])
+
+    def test_constant_store_cost(self):
+        c = CountingCache(SimpleCache(threshold=10000))
+        s = Store(c, Config(resource_index=True))
+        def operations(paths):
+            c.operations.clear()
+            for path in paths:
+                with a.test_request_context(path):
+                    s.index_resource(path, 60, 3)
+            return sum(c.operations.values())
+        operations(['/products/%d' % i for i in range(10)])
+        few = operations(['/products/a%d' % i for i in range(10)])
+        operations(['/products/%d' % i for i in range(10, 500)])
+        self.assertEquals(operations(['/products/b%d' % i for i in range(10)]), few)
+        self.assertEquals(len(s.indexed_resources('/products/')), 520)
+
+    def test_slots(self):
+        self.cache('/foo/bar')
+        slot = self.s.indexed_resource('/foo/bar')['slot']
+        self.cache('/foo/bar')
+        self.assertEquals(self.s.indexed_resource('/foo/bar')['slot'], slot)
+        self.assertIsNone(self.s.indexed_resource('/foo/baz'))
+        self.cache('/a:1/x') # segments with separators don't clash
+        self.cache('/a/y')
+        self.assertEquals(sorted(self.s.indexed_resources('/a')), ['/a/y', '/a:1/x'])
+        self.assertEquals(self.s.indexed_segments(), {'foo', 'a:1', 'a'})
+
+    def test_slot_reuse(self):
+        self.cache('/foo/bar')
+        self.cache('/foo/baz')
+        generation = self.c.get(self.s.index_cache_key('generation', 'foo'))['id']
+        counter = self.s.index_cache_key('slots', generation, 'foo')
+        self.assertEquals(self.c.get(counter), 2)
+        with a.test_request_context('/foo/bar', method='PUT'):
+            self.s.invalidate_resource()
+        storage.time = lambda: time() + 400 # /foo/baz expired too
+        try:
+            self.assertEquals(self.s.indexed_resources(), {})
+            self.cache('/foo/bar')
+            self.cache('/foo/baz')
+        finally:
+            storage.time = time
+        self.assertEquals(self.c.get(counter), 2)
+        self.assertEquals(sorted(self.s.indexed_resources()), ['/foo/bar', '/foo/baz'])
+
+    def test_generations(self):
+        self.cache('/foo/bar')
+        self.cache('/foo/baz')
+        key = self.s.index_cache_key('generation', 'foo')
+        old = self.c.get(key)['id']
+        self.c.delete(key) # as when all of the segment's entries expired
+        self.assertEquals(self.s.indexed_resources(), {})
+        self.cache('/foo/baz')
+        new = self.c.get(key)['id']
+        self.assertNotEquals(new, old)
+        self.assertIsNone(self.c.get(self.s.index_cache_key('slots', old, 'foo')))
+        self.assertEquals(self.c.get(self.s.index_cache_key('slots', new, 'foo')), 1)
+        self.assertEquals(list(self.s.indexed_resources()), ['/foo/baz'])
+        self.assertEquals(self.c.get(self.s.index_cache_key('segments')), 1)
+
+    def test_lost_counter(self):
+        self.cache('/foo/bar')
+        generation = self.c.get(self.s.index_cache_key('generation', 'foo'))['id']
+        self.c.delete(self.s.index_cache_key('slots', generation, 'foo'))
+        self.cache('/foo/baz') # slot 1 is taken, so it gets slot 2
+        self.assertEquals(sorted(self.s.indexed_resources()), ['/foo/bar', '/foo/baz'])
+
+    def test_failing_backend(self):
+        c = FlakyCache()
+        s = Store(c, Config(resource_index=True))
+        for path, failing in (('/new/foo', True), ('/foo/foo', False),
+                              ('/foo/bar', True), ('/foo/baz', False)):
+            c.failing = failing
+            with a.test_request_context(path):
+                s.cache_response(Response('foo'))
+        generation = c.get(s.index_cache_key('generation', 'foo'))['id']
+        self.assertEquals(c.get(s.index_cache_key('slots', generation, 'foo')), 2)
+        self.assertEquals(sorted(s.indexed_resources()), ['/foo/baz', '/foo/foo'])
+
+    def test_invalidation_unindexes(self):
+        self.cache('/foo/bar')
+        self.cache('/foo/baz')
+        with a.test_request_context('/foo/bar', method='PUT'):
+            self.s.invalidate_resource()
+        self.assertEquals(list(self.s.indexed_resources()), ['/foo/baz'])
+
+    def test_purge(self):
+        self.cache('/foo/bar')
+        self.cache('/food')
+        self.assertEquals(self.s.purge_resources('/foo/'), ['/foo/bar'])
+        self.assertIsNone(self.c.get(self.s.metadata_cache_key('/foo/bar')))
+        self.assertIsNotNone(self.c.get(self.s.metadata_cache_key('/food')))
+        self.assertEquals(list(self.s.indexed_resources()), ['/food'])
+
+class RevalidationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.version = 'v1'
+        self.app = Flask(__name__)
+        @self.app.route('/foo/<name>')
+        @revalidate_with(lambda name: self.version + name)
+        def foo(name):
+            return name
+        @self.app.route('/bar')
+        def bar():
+            return 'bar'
+        self.c = SimpleCache()
+        cfg = Config(revalidation_seconds=3600)
+        self.s = Store(self.c, cfg)
+        self.r = Retrieval(self.c, cfg)
+
+    def cache_stale_response(self, path, version):
+        with self.app.test_request_context(path):
+            r = Response('foo')
+            r.webcache_version = version
+            r.date = datetime.utcnow() - timedelta(seconds=100)
+            r.expires = datetime.utcnow() - timedelta(seconds=90)
+            r.cache_control.max_age = 10
+            self.s.cache_response(r)
+
+    def test_retention(self):
+        r = Response()
+        self.assertEquals(self.s.retention_seconds(r, 10), 10)
+        r.webcache_version = 'v1'
+        self.assertEquals(self.s.retention_seconds(r, 10), 3610)
+        self.assertEquals(Store(self.c).retention_seconds(r, 10), 10)
+
+    def test_modifier_sets_version(self):
+        with self.app.test_request_context('/foo/qux'):
+            setup_for_this_request()
+            self.app.view_functions['foo'](name='qux')
+            r = Response()
+            for modifier in after_request:
+                modifier(r)
+            self.assertEquals(r.webcache_version, 'v1qux')
+
+    def test_revalidation(self):
+        self.cache_stale_response('/foo/qux', 'v1qux')
+        with self.app.test_request_context('/foo/qux'):
+            r = self.r.fetch_response()
+            self.assertTrue(compare_numbers(10, self.r.response_freshness_seconds(r), 1))
+            self.assertTrue(compare_numbers(10, (r.expires - r.date).total_seconds(), 1))
+            self.assertEquals(r.data, b'foo')
+        with self.app.test_request_context('/foo/qux'):
+            r = self.r.fetch_response()
+            self.assertTrue(compare_numbers(10, self.r.response_freshness_seconds(r), 1))
+
+    def test_changed_version(self):
+        self.cache_stale_response('/foo/qux', 'v0qux')
+        with self.app.test_request_context('/foo/qux'):
+            self.assertRaises(StaleRepresentation, self.r.fetch_response)
+
+    def test_no_version_provider(self):
+        self.cache_stale_response('/bar', 'v1qux')
+        with self.app.test_request_context('/bar'):
+            self.assertRaises(StaleRepresentation, self.r.fetch_response)
+
 class RecacheTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -252,6 +550,45 @@ class RecacheTestCase(unittest.TestCase):
             self.c.clear()
             self.assertTrue(self.r.should_recache_preemptively(10, m))
 
+    def test_probabilistic_recaching_predicate(self):
+        seed(0)
+        r = Retrieval(self.c, Config(preemptive_recache_beta=1.0,
+                                     preemptive_recache_callback=lambda salt: None))
+        response = Response()
+        self.assertFalse(r.should_recache_probabilistically(0.001, response))
+        response.webcache_render_seconds = 1.0
+        self.assertTrue(r.should_recache_probabilistically(0, response))
+        self.assertFalse(r.should_recache_probabilistically(100, response))
+        # P(recache) is exp(-freshness/(render_seconds*beta))
+        hits = sum(r.should_recache_probabilistically(1, response) for i in range(2000))
+        self.assertTrue(0.3 < hits / 2000.0 < 0.45)
+        hits = sum(r.should_recache_probabilistically(0.1, response) for i in range(2000))
+        self.assertTrue(0.85 < hits / 2000.0 < 0.95)
+        no_callback = Retrieval(self.c, Config(preemptive_recache_beta=1.0))
+        self.assertFalse(no_callback.should_recache_probabilistically(0, response))
+
+    def test_probabilistic_recaching(self):
+        recached = []
+        cfg = Config(preemptive_recache_beta=1.0, preemptive_recache_seconds=10,
+                     preemptive_recache_callback=recached.append)
+        s, r = Store(self.c, cfg), Retrieval(self.c, cfg)
+        with a.test_request_context('/foo'):
+            g.webcache_request_started = time() - 1000 # a very slow render
+            response = Response('foo')
+            response.date = datetime.utcnow()
+            s.cache_response(response)
+            self.assertTrue(compare_numbers(1000, response.webcache_render_seconds, 1))
+        # with this draw, hits recache while fresher than 1000 * -log(0.5)s
+        storage.random = lambda: 0.5
+        try:
+            with a.test_request_context('/foo'):
+                r.fetch_response()
+                r.fetch_response()
+                self.assertIsNone(self.c.get(r.recache_cache_key(r.fetch_metadata())))
+        finally:
+            storage.random = random
+        self.assertEquals(len(recached), 2) # no locking
+
     def test_preemptive_recaching_cache_bypass(self):
         fresh = Response('foo')
         with a.test_request_context('/foo'):
@@ -279,3 +616,7 @@ class UtilityTestCase(unittest.TestCase):
     def test_werkzeug_cache_get_or_add_existing_key(self):
         self.c.set('foo', 'bar')
         self.assertEquals('bar', werkzeug_cache_get_or_add(self.c, 'foo', 'qux', 10))
+
+    def test_werkzeug_cache_get_or_add_not_storing(self):
+        from werkzeug.contrib.cache import NullCache
+        self.assertEquals('bar', werkzeug_cache_get_or_add(NullCache(), 'foo', 'bar', 10))